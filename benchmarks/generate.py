@@ -0,0 +1,52 @@
+import os
+import duckdb
+
+# A tall table: many rows, a handful of columns of the types Datasette sees
+# most often.
+TALL_SQL = '''
+SELECT
+    i AS id,
+    'category_' || (i % 20) AS category,
+    (i * 7919) % 100000 / 100.0 AS amount,
+    DATE '2020-01-01' + CAST(i % 1000 AS INTEGER) AS day,
+    TIMESTAMP '2020-01-01 00:00:00' + INTERVAL (i % 100000) SECOND AS ts,
+    'name ' || i AS name,
+    2020 + i % 4 AS year,
+    1 + i % 12 AS month
+FROM range({rows}) t(i)
+'''
+
+def wide_sql(rows, columns):
+    cols = ['i AS id'] + ['(i * {}) % 1000 AS c{}'.format(n + 1, n) for n in range(columns - 1)]
+    return 'SELECT {} FROM range({}) t(i)'.format(', '.join(cols), rows)
+
+def generate(dirname, rows=100000, wide_rows=None, wide_columns=100):
+    """Writes synthetic datasets to dirname, returning a dict of name -> path.
+
+    - tall.parquet, tall_csv.csv, tall_jsonl.jsonl: the same rows in each
+      format, each its own view
+    - wide.parquet: fewer rows, but wide_columns columns
+    - partitioned/: tall, Hive-partitioned by year and month"""
+    if wide_rows is None:
+        wide_rows = max(1, rows // 10)
+
+    os.makedirs(dirname, exist_ok=True)
+    conn = duckdb.connect()
+    tall = TALL_SQL.format(rows=rows)
+
+    rv = {
+        'tall.parquet': os.path.join(dirname, 'tall.parquet'),
+        'tall_csv.csv': os.path.join(dirname, 'tall_csv.csv'),
+        'tall_jsonl.jsonl': os.path.join(dirname, 'tall_jsonl.jsonl'),
+        'wide.parquet': os.path.join(dirname, 'wide.parquet'),
+        'partitioned': os.path.join(dirname, 'partitioned'),
+    }
+
+    conn.execute("COPY ({}) TO '{}' (FORMAT PARQUET)".format(tall, rv['tall.parquet']))
+    conn.execute("COPY ({}) TO '{}' (FORMAT CSV, HEADER)".format(tall, rv['tall_csv.csv']))
+    conn.execute("COPY ({}) TO '{}' (FORMAT JSON)".format(tall, rv['tall_jsonl.jsonl']))
+    conn.execute("COPY ({}) TO '{}' (FORMAT PARQUET)".format(wide_sql(wide_rows, wide_columns), rv['wide.parquet']))
+    conn.execute("COPY ({}) TO '{}' (FORMAT PARQUET, PARTITION_BY (year, month), OVERWRITE_OR_IGNORE)".format(tall, rv['partitioned']))
+    conn.close()
+
+    return rv
@@ -0,0 +1,199 @@
+"""Benchmarks for the SQLite-to-DuckDB facade.
+
+    python -m benchmarks.run --rows 1000000 --output results.json
+
+Results are written as JSON, one entry per benchmark, with timings in
+milliseconds, so runs against different versions can be diffed."""
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import duckdb
+import sqlglot
+import datasette
+from datasette.app import Datasette
+from datasette_parquet.ducky import DuckDatabase, sync_views
+from datasette_parquet.timelimit import watchdog
+from datasette_parquet.rewrite import rewrite
+from datasette_parquet.winging_it import ProxyConnection, fixup_params
+from .generate import generate
+
+# Representative queries, in the shape Datasette sends them.
+QUERIES = {
+    'count': ('select count(*) from [tall] ', {}),
+    'table_page': ('select id, category, amount, day, ts, name, year, month from [tall] limit 101', {}),
+    'filtered_page': ('select * from [tall] where "category" = :p0 limit 101', {'p0': 'category_3'}),
+    'facet': ('select category as value, count(*) as count from (select * from [tall] ) where category is not null group by category order by count desc, value limit 31', {}),
+    'table_xinfo': ('PRAGMA table_xinfo([tall])', {}),
+    'count_csv': ('select count(*) from [tall_csv] ', {}),
+    'filtered_page_csv': ('select * from [tall_csv] where "category" = :p0 limit 101', {'p0': 'category_3'}),
+    'count_jsonl': ('select count(*) from [tall_jsonl] ', {}),
+    'filtered_page_jsonl': ('select * from [tall_jsonl] where "category" = :p0 limit 101', {'p0': 'category_3'}),
+    'wide_page': ('select * from [wide] limit 101', {}),
+    'wide_filtered_page': ('select * from [wide] where "c10" = :p0 limit 101', {'p0': 7}),
+}
+
+REQUESTS = {
+    'table': '/bench/tall.json',
+    'table_filtered': '/bench/tall.json?category=category_3',
+    'facets': '/bench/tall.json?_facet=category&_facet=year',
+    'partition_filter': '/bench/partitioned.json?year=2021',
+    'csv_export': '/bench/tall.csv?_stream=on&_size=max',
+    'table_csv': '/bench/tall_csv.json?category=category_3',
+    'table_jsonl': '/bench/tall_jsonl.json?category=category_3',
+    'table_wide': '/bench/wide.json',
+    'facets_wide': '/bench/wide.json?_facet=c1&_facet=c2',
+}
+
+def measure(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'n': repeat,
+        'min_ms': min(times),
+        'median_ms': statistics.median(times),
+        'mean_ms': statistics.mean(times),
+        'max_ms': max(times),
+    }
+
+def bench_rewrite(conn, repeat):
+    rv = {}
+    for name, (sql, params) in QUERIES.items():
+        rv['rewrite.' + name] = measure(lambda: rewrite(sql), repeat)
+
+        # What a query pays once the rewrite cache is warm.
+        conn.prepare(sql, params)
+        rv['prepare_cached.' + name] = measure(lambda: conn.prepare(sql, params), repeat)
+
+        rewritten = rewrite(sql)
+        rv['fixup_params.' + name] = measure(lambda: fixup_params(rewritten, params), repeat)
+    return rv
+
+def bench_fetch(conn, repeat):
+    sql = 'SELECT * FROM tall'
+
+    def fetchall():
+        conn.execute(sql).fetchall()
+
+    def fetchmany():
+        cursor = conn.execute(sql)
+        while cursor.fetchmany(1000):
+            pass
+
+    def iterate():
+        for row in conn.execute(sql):
+            pass
+
+    return {
+        'fetch.fetchall': measure(fetchall, repeat),
+        'fetch.fetchmany': measure(fetchmany, repeat),
+        'fetch.iterate': measure(iterate, repeat),
+    }
+
+def bench_startup(dirname, repeat):
+    def startup():
+        conn = duckdb.connect()
+        sync_views(conn, dirname, {})
+        conn.close()
+
+    return {
+        'startup.sync_views': measure(startup, repeat),
+    }
+
+def bench_requests(dirname, repeat):
+    ds = Datasette(
+        [],
+        memory=True,
+        settings={'sql_time_limit_ms': 600000, 'max_returned_rows': 1000},
+        metadata={
+            'plugins': {
+                'datasette-parquet': {
+                    'bench': {
+                        'directory': dirname,
+                    }
+                }
+            }
+        }
+    )
+
+    async def fetch(path):
+        response = await ds.client.get(path)
+        if response.status_code != 200:
+            raise Exception('{} returned {}: {}'.format(path, response.status_code, response.text[:200]))
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(ds.invoke_startup())
+        return {
+            'request.' + name: measure(lambda: loop.run_until_complete(fetch(path)), repeat)
+            for name, path in REQUESTS.items()
+        }
+    finally:
+        loop.close()
+        for db in ds.databases.values():
+            if isinstance(db, DuckDatabase):
+                db.close()
+        watchdog.shutdown()
+
+GROUPS = ['rewrite', 'fetch', 'startup', 'request']
+
+def run(rows=100000, repeat=5, data_dir=None, groups=GROUPS):
+    if data_dir is None:
+        data_dir = tempfile.mkdtemp(prefix='datasette-parquet-bench-')
+
+    generate(data_dir, rows=rows)
+
+    conn = ProxyConnection(duckdb.connect())
+    sync_views(conn.conn, data_dir, {})
+
+    results = {}
+    if 'rewrite' in groups:
+        # rewrite() is quick, so repeat it more to get a stable reading.
+        results.update(bench_rewrite(conn, repeat * 100))
+    if 'fetch' in groups:
+        results.update(bench_fetch(conn, repeat))
+    if 'startup' in groups:
+        results.update(bench_startup(data_dir, repeat))
+    if 'request' in groups:
+        results.update(bench_requests(data_dir, repeat))
+
+    return {
+        'meta': {
+            'rows': rows,
+            'repeat': repeat,
+            'python': platform.python_version(),
+            'duckdb': duckdb.__version__,
+            'sqlglot': sqlglot.__version__,
+            'datasette': datasette.__version__,
+        },
+        'results': results,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark datasette-parquet')
+    parser.add_argument('--rows', type=int, default=100000, help='rows in the tall datasets')
+    parser.add_argument('--repeat', type=int, default=5, help='times to run each benchmark')
+    parser.add_argument('--data-dir', help='where to write the synthetic data; defaults to a temporary directory')
+    parser.add_argument('--only', action='append', choices=GROUPS, help='only run these groups of benchmarks')
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    rv = run(rows=args.rows, repeat=args.repeat, data_dir=args.data_dir, groups=args.only or GROUPS)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(rv, f, indent=2)
+    else:
+        json.dump(rv, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
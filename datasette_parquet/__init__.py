@@ -1,4 +1,5 @@
 from datasette import hookimpl
+from datasette.utils.asgi import Response
 
 PLUGIN_NAME = 'datasette-parquet'
 
@@ -11,21 +12,109 @@ def startup(datasette):
     if not config:
         return
 
-    from .ducky import DuckDatabase
+    from .ducky import DuckDatabase, duckdb_config
+    from .shared import SharedInstance
+    from .export import json_renderer
     from .patches import monkey_patch
 
     monkey_patch()
 
+    # Convert DuckDB rows to JSON a column at a time.
+    render, can_render = datasette.renderers['json']
+    datasette.renderers['json'] = (json_renderer(render), can_render)
+
+    # Databases with shared: true live in one DuckDB instance, whose limits
+    # they share.
+    shared = False
+    shared_config = {}
+    shared_http_cache = {}
+    for db_name, options in config.items():
+        if options.get('shared', False) != True:
+            continue
+
+        for key, value in duckdb_config(
+            options.get('threads'),
+            options.get('memory_limit'),
+            options.get('temp_directory'),
+            options.get('object_cache')
+        ).items():
+            if shared_config.get(key, value) != value:
+                raise Exception('datasette-parquet: shared databases have different values for {}'.format(key))
+            shared_config[key] = value
+
+        # They share one cache of remote files, too.
+        for key in ('http_cache', 'http_cache_bytes', 'http_timeout_seconds'):
+            value = options.get(key)
+            if value is not None:
+                if shared_http_cache.get(key, value) != value:
+                    raise Exception('datasette-parquet: shared databases have different values for {}'.format(key))
+                shared_http_cache[key] = value
+        shared = True
+
+    instance = SharedInstance(shared_config) if shared else None
+
     for db_name, options in config.items():
         if not 'directory' in options and not 'file' in options:
             raise Exception('datasette-parquet: expected directory or file key for db {}'.format(db))
 
+        common = dict(
+            rewrite_cache_size=options.get('rewrite_cache_size'),
+            statement_cache_size=options.get('statement_cache_size'),
+            pool_size=options.get('pool_size'),
+            result_cache_bytes=options.get('result_cache_bytes'),
+            profile_threshold_ms=options.get('profile_threshold_ms'),
+            max_queued=options.get('max_queued'),
+            suggest_sample_rows=options.get('suggest_sample_rows'),
+            httpfs=options.get('httpfs', False) == True,
+            threads=options.get('threads'),
+            memory_limit=options.get('memory_limit'),
+            temp_directory=options.get('temp_directory'),
+            object_cache=options.get('object_cache'),
+            http_cache=options.get('http_cache'),
+            http_cache_bytes=options.get('http_cache_bytes'),
+            http_timeout_seconds=options.get('http_timeout_seconds'),
+            export_time_limit_ms=options.get('export_time_limit_ms'),
+            instance=instance if options.get('shared', False) == True else None,
+            mount=db_name
+        )
+
         if 'directory' in options:
             directory = options['directory']
-            db = DuckDatabase(datasette, directory=directory, watch=options.get('watch', False) == True)
+            db = DuckDatabase(
+                datasette,
+                directory=directory,
+                watch=options.get('watch', False) == True,
+                catalog=options.get('catalog'),
+                parquet_cache=options.get('parquet_cache'),
+                fts=options.get('fts'),
+                **common
+            )
             datasette.add_database(db, db_name)
         else:
             file = options['file']
-            db = DuckDatabase(datasette, file=file)
+            db = DuckDatabase(datasette, file=file, **common)
             datasette.add_database(db, db_name)
 
+async def duckdb_stats(datasette, request):
+    await datasette.ensure_permissions(request.actor, ['view-instance'])
+
+    from .ducky import DuckDatabase
+
+    try:
+        top = int(request.args.get('top', 10))
+        if top < 0:
+            raise ValueError
+    except ValueError:
+        return Response.json({'ok': False, 'error': 'top must be a non-negative integer'}, status=400)
+
+    return Response.json({
+        name: db.summary(top)
+        for name, db in datasette.databases.items()
+        if isinstance(db, DuckDatabase)
+    })
+
+@hookimpl
+def register_routes():
+    return [
+        (r'^/-/duckdb(\.json)?$', duckdb_stats),
+    ]
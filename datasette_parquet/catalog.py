@@ -0,0 +1,80 @@
+import json
+import os
+import threading
+import duckdb
+from .ddl import source_for
+
+CATALOG_VERSION = 1
+
+class SchemaCatalog:
+    """An on-disk record of the column schemas of a directory's views.
+
+    DuckDB sniffs the schema of CSV and JSON files every time it binds a
+    view over them. With thousands of files, that makes startup (and every
+    query) slow. Instead, we sniff each view once and remember its columns,
+    keyed by the path, mtime and size of the file that was sniffed. On
+    restart, only views whose files have changed are sniffed again.
+
+    config is passed to duckdb.connect for the connection that sniffs."""
+
+    def __init__(self, path, config=None):
+        self.path = path
+        self.config = config or {}
+        self.lock = threading.Lock()
+        self.conn = None
+        self.dirty = False
+        self.entries = {}
+
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == CATALOG_VERSION:
+                self.entries = data['views']
+        except (FileNotFoundError, ValueError, KeyError):
+            # Missing or corrupt: start afresh, it's only a cache.
+            pass
+
+    def sniff(self, fname, glob):
+        if self.conn is None:
+            self.conn = duckdb.connect(config=self.config)
+
+        rows = self.conn.execute('DESCRIBE SELECT * FROM {}'.format(source_for(fname, glob))).fetchall()
+        return [[row[0], row[1]] for row in rows]
+
+    def columns(self, view_name, fname, glob):
+        """Returns the [name, type] pairs for a view, sniffing them if needed."""
+        st = os.stat(fname)
+        key = [fname, st.st_mtime_ns, st.st_size]
+
+        with self.lock:
+            entry = self.entries.get(view_name)
+            if entry and entry['glob'] == glob and entry['file'] == key:
+                return entry['columns']
+
+            columns = self.sniff(fname, glob)
+            self.entries[view_name] = {
+                'glob': glob,
+                'file': key,
+                'columns': columns,
+            }
+            self.dirty = True
+            return columns
+
+    def retain(self, view_names):
+        """Forgets views that are no longer in the directory."""
+        with self.lock:
+            for view_name in list(self.entries):
+                if not view_name in view_names:
+                    del self.entries[view_name]
+                    self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+
+            tmp = '{}.tmp'.format(self.path)
+            with open(tmp, 'w') as f:
+                json.dump({'version': CATALOG_VERSION, 'views': self.entries}, f)
+            os.replace(tmp, self.path)
+            self.dirty = False
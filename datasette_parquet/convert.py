@@ -0,0 +1,123 @@
+import hashlib
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+import duckdb
+from .counts import fingerprint
+from .ddl import source_for
+
+# How long an old copy is kept after its view moves to a new one, so that
+# queries that were already reading it can finish.
+DEFAULT_GRACE_SECONDS = 300
+
+class ParquetConverter:
+    """Convert CSV, TSV and JSON Lines sources to Parquet in the background.
+
+    Text files have to be re-parsed on every query. Once a source has been
+    converted, its view can read the Parquet copy instead, which gets
+    projection and predicate pushdown.
+
+    Converted files are named after the view and a hash of the source files'
+    paths, mtimes and sizes, so a changed source is converted again. When a
+    conversion finishes, on_converted is called so the views can be updated.
+
+    Old copies are retired once their view has moved over, and removed by
+    remove_retired once they've been retired for grace_seconds.
+
+    config is passed to duckdb.connect for the connections that convert, so
+    a big conversion respects the same memory and thread limits as queries."""
+
+    def __init__(self, cache_dir, on_converted=None, config=None, grace_seconds=DEFAULT_GRACE_SECONDS):
+        self.cache_dir = cache_dir
+        self.config = config or {}
+        self.on_converted = on_converted
+        self.grace_seconds = grace_seconds
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.failed = set()
+        self.retired = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='datasette-parquet-convert')
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def target_for(self, view_name, glob):
+        fp = fingerprint(glob)
+        if not fp:
+            return None
+
+        digest = hashlib.sha1(repr((glob, fp)).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, '{}.{}.parquet'.format(view_name, digest))
+
+    def converted(self, view_name, fname, glob):
+        """Returns the path of the Parquet copy of glob, or None if it's not ready.
+
+        If it's not ready, a conversion is started."""
+        target = self.target_for(view_name, glob)
+        if target is None:
+            return None
+
+        if os.path.exists(target):
+            return target
+
+        with self.lock:
+            if not target in self.pending and not target in self.failed:
+                self.pending[target] = self.executor.submit(self.convert, view_name, fname, glob, target)
+
+        return None
+
+    def convert(self, view_name, fname, glob, target):
+        tmp = '{}.tmp'.format(target)
+        try:
+            conn = duckdb.connect(config=self.config)
+            try:
+                conn.execute("COPY (SELECT * FROM {}) TO '{}' (FORMAT PARQUET)".format(source_for(fname, glob), tmp))
+            finally:
+                conn.close()
+            os.replace(tmp, target)
+        except Exception as e:
+            sys.stderr.write('datasette-parquet: failed to convert {} to Parquet: {}\n'.format(glob, e))
+            sys.stderr.flush()
+            with self.lock:
+                self.failed.add(target)
+                del self.pending[target]
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+
+        with self.lock:
+            del self.pending[target]
+
+        if self.on_converted:
+            self.on_converted()
+
+        # Only now that the view has moved over to the new copy.
+        self.retire_stale(view_name, target)
+
+    def retire_stale(self, view_name, target):
+        now = time.monotonic()
+        for f in os.scandir(self.cache_dir):
+            if f.path != target and f.name.endswith('.parquet') and f.name.rsplit('.', 2)[0] == view_name:
+                with self.lock:
+                    self.retired.setdefault(f.path, now)
+
+    def remove_retired(self):
+        """Removes the old copies that nothing should be reading any more."""
+        now = time.monotonic()
+        with self.lock:
+            expired = [path for path, retired in self.retired.items() if now - retired >= self.grace_seconds]
+            for path in expired:
+                del self.retired[path]
+
+        for path in expired:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def wait(self):
+        """Blocks until all the conversions started so far have finished."""
+        with self.lock:
+            futures = list(self.pending.values())
+        wait(futures)
@@ -0,0 +1,152 @@
+import glob
+import os
+import re
+import threading
+from .ddl import is_recursive
+
+# What Datasette's table and database pages send for an unfiltered count,
+# after it's been through rewrite()
+count_star_re = re.compile(r'^SELECT COUNT\(\*\) FROM "((?:[^"]|"")+)"$')
+
+# What Datasette's table page sends for a page of an unfiltered view, after
+# it's been through rewrite(): * or a list of plain columns. Anything else in
+# the select list, like DISTINCT, aggregates or window functions, works on
+# the rows the LIMIT and OFFSET apply to, so it can't be answered this way.
+identifier = r'(?:"(?:[^"]|"")+"|[A-Za-z_][A-Za-z0-9_]*)'
+page_re = re.compile(r'^SELECT (\*|{0}(?:, {0})*) FROM ({0}) LIMIT (\d+) OFFSET (\d+)$'.format(identifier))
+
+# One row per column chunk, in the order DuckDB reads the files.
+ROW_GROUPS_SQL = '''
+SELECT file_name, row_group_id, row_group_num_rows
+FROM parquet_metadata(?)
+'''
+
+def quote_string(value):
+    return "'{}'".format(value.replace("'", "''"))
+
+def fingerprint(pattern):
+    rv = []
+    for fname in sorted(glob.glob(pattern, recursive=True)):
+        st = os.stat(fname)
+        rv.append((fname, st.st_mtime_ns, st.st_size))
+    return tuple(rv)
+
+class ParquetCounts:
+    """Answer queries on Parquet views from the file footers.
+
+    Parquet files record how many rows they have, so there's no need to scan
+    them to answer an unfiltered count(*). Each file's count is cached per
+    view, and recomputed when the mtime or size of any of the view's files
+    changes.
+
+    The counts also tell us which rows of which files make up a page of a
+    view. Views have no primary key, so Datasette pages through them with
+    OFFSET, which reads and throws away every row before the page. Instead,
+    we read the page's rows by their file_row_number, which DuckDB uses to
+    skip straight to the right row groups, so a deep page costs the same as
+    the first."""
+
+    def __init__(self, globs=None):
+        self.globs = globs or {}
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    def set_globs(self, globs):
+        self.globs = globs
+
+    def files(self, conn, view_name):
+        """Returns a list of (file name, row count) for the files behind
+        view_name, in the order DuckDB reads them, or None."""
+        pattern = self.globs[view_name]
+        fp = fingerprint(pattern)
+
+        if not fp:
+            return None
+
+        with self.lock:
+            cached = self.cache.get(view_name)
+        if cached and cached[0] == fp:
+            return cached[1]
+
+        row_groups = {}
+        for file_name, row_group_id, num_rows in conn.execute(ROW_GROUPS_SQL, [pattern]).fetchall():
+            row_groups[(file_name, row_group_id)] = num_rows
+
+        counts = {}
+        for (file_name, _), num_rows in row_groups.items():
+            counts[file_name] = counts.get(file_name, 0) + num_rows
+        rv = list(counts.items())
+
+        with self.lock:
+            self.cache[view_name] = (fp, rv)
+        return rv
+
+    def count(self, conn, view_name):
+        files = self.files(conn, view_name)
+        if files is None:
+            return None
+        return sum(rows for _, rows in files)
+
+    def page_sql(self, conn, view_name, columns, limit, offset):
+        """Returns a query for rows offset to offset + limit of view_name
+        that reads only the row groups they're in, or None."""
+        # A partitioned view's columns come from its directories, too.
+        if is_recursive(self.globs[view_name]):
+            return None
+
+        files = self.files(conn, view_name)
+        if files is None:
+            return None
+
+        parts = []
+        start = 0
+        for file_name, rows in files:
+            end = start + rows
+            if end > offset and start < offset + limit:
+                parts.append(
+                    "SELECT *, {} AS datasette_part FROM read_parquet({}, file_row_number=true) WHERE file_row_number >= {} AND file_row_number < {}".format(
+                        len(parts),
+                        quote_string(file_name),
+                        max(0, offset - start),
+                        min(rows, offset + limit - start)
+                    )
+                )
+            start = end
+
+        # Past the end: there's nothing to read.
+        if not parts:
+            return None
+
+        if columns == '*':
+            columns = '* EXCLUDE (file_row_number, datasette_part)'
+
+        return 'SELECT {} FROM ({}) ORDER BY datasette_part, file_row_number'.format(
+            columns,
+            ' UNION ALL '.join(parts)
+        )
+
+    def rewrite(self, conn, sql):
+        """Returns a query that answers sql from cached metadata, or None."""
+        m = count_star_re.search(sql)
+        if m:
+            view_name = m.group(1).replace('""', '"')
+            if not view_name in self.globs:
+                return None
+
+            count = self.count(conn, view_name)
+            if count is None:
+                return None
+
+            return 'SELECT {} AS "count_star()"'.format(int(count))
+
+        m = page_re.search(sql)
+        if m:
+            view_name = m.group(2)
+            if view_name.startswith('"'):
+                view_name = view_name[1:-1].replace('""', '"')
+            if not view_name in self.globs:
+                return None
+
+            return self.page_sql(conn, view_name, m.group(1), int(m.group(3)), int(m.group(4)))
+
+        return None
@@ -2,32 +2,148 @@ import os
 import json
 from pathlib import Path
 
-def view_for(view_name, fname, glob):
-    view_name = view_name.replace('.', '_')
+EXTENSIONS = ('.csv', '.tsv', '.parquet', '.ndjson', '.jsonl')
+
+def view_name_for(name):
+    return name.replace('.', '_')
+
+def columns_literal(columns):
+    """Renders a list of (name, type) pairs as a DuckDB struct literal."""
+    return '{' + ', '.join("'{}': '{}'".format(name.replace("'", "''"), type) for name, type in columns) + '}'
+
+def is_recursive(glob):
+    return '**' in glob
+
+def source_for(fname, glob, columns=None):
+    """Returns the table expression that reads glob, or None if we can't read it.
+
+    If columns is given, text formats use them rather than sniffing the types.
+
+    Recursive globs read partitioned directories: key=value directory names
+    become columns, and files may have differing columns."""
+    options = ''
+    if is_recursive(glob):
+        options = ', hive_partitioning=true, union_by_name=true'
+
     if fname.endswith(('.csv', '.tsv')):
-        return "CREATE VIEW \"{}\" AS SELECT * FROM read_csv_auto('{}', header=true)".format(view_name, glob)
+        if columns:
+            return "read_csv_auto('{}', header=true{}, columns={})".format(glob, options, columns_literal(columns))
+        return "read_csv_auto('{}', header=true{})".format(glob, options)
     elif fname.endswith('.parquet'):
-        return "CREATE VIEW \"{}\" AS SELECT * FROM '{}'".format(view_name, glob)
+        if options:
+            return "read_parquet('{}'{})".format(glob, options)
+        return "'{}'".format(glob)
     elif fname.endswith(('.ndjson', '.jsonl')):
-        return "CREATE VIEW \"{}\" AS SELECT * FROM read_ndjson_auto('{}')".format(view_name, glob)
+        if columns:
+            return "read_ndjson('{}'{}, columns={})".format(glob, options, columns_literal(columns))
+        return "read_ndjson_auto('{}'{})".format(glob, options)
 
-def create_views(dirname):
+def view_for(view_name, fname, glob, columns=None):
+    view_name = view_name_for(view_name)
+    source = source_for(fname, glob, columns)
+    if source:
+        return "CREATE VIEW \"{}\" AS SELECT * FROM {}".format(view_name, source)
+
+def scan_directory(dirname):
+    """Returns the first data file under dirname, and whether it has subdirectories.
+
+    Files and directories that start with _ or . are skipped, as these are
+    usually bookkeeping, like Spark's _SUCCESS files."""
+    first = None
+    nested = False
+    for root, dirs, files in os.walk(dirname):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(('_', '.')))
+        if dirs:
+            nested = True
+
+        if first is None:
+            for f in sorted(files):
+                if f.endswith(EXTENSIONS) and not f.startswith(('_', '.')):
+                    first = os.path.join(root, f)
+                    break
+
+        if first and nested:
+            break
+
+    return first, nested
+
+def discover_views(dirname):
+    """Returns a list of (view_name, fname, glob) tuples, one per candidate view.
+
+    fname is the file whose extension determines how the view reads glob.
+
+    A subdirectory becomes one view over all the files in it. If it has
+    subdirectories of its own, like a Hive-partitioned dataset with
+    year=2023/month=01/ directories, they're included too."""
     rv = []
 
     # Add in sorted order so the user sees alphabetically stable sort
     for f in sorted(os.scandir(dirname), key=lambda x: x.path):
         fname = f.path
         if f.is_dir():
-            files = list(os.scandir(f.path))
+            # We only sniff the first file, we assume all files in the directory
+            # will have the same extension. YOLO.
+            file, nested = scan_directory(fname)
 
-            if not files:
+            if not file:
                 continue
 
-            # We only sniff the first file, we assume all files in the directory
-            # will have the same extension and shape. YOLO.
-            file = files[0]
-            rv.append(view_for(Path(fname).stem, file.path, os.path.join(fname, '*' + Path(file).suffix)))
+            if nested:
+                glob = os.path.join(fname, '**', '*' + Path(file).suffix)
+            else:
+                glob = os.path.join(fname, '*' + Path(file).suffix)
+            rv.append((Path(fname).stem, file, glob))
         else:
-            rv.append(view_for(Path(fname).stem, fname, fname))
+            rv.append((Path(fname).stem, fname, fname))
+
+    return rv
+
+def is_text(fname):
+    return fname.endswith(('.csv', '.tsv', '.ndjson', '.jsonl'))
+
+def view_definitions(dirname, catalog=None, converter=None):
+    """Returns a dict of view name -> CREATE VIEW statement, in display order.
+
+    If a SchemaCatalog is given, views are created with the column types it
+    knows, so DuckDB doesn't have to sniff them.
+
+    If a ParquetConverter is given, views over text files read the Parquet
+    copy of them instead, once it's ready."""
+    rv = {}
+    for view_name, fname, glob in discover_views(dirname):
+        view_name = view_name_for(view_name)
+
+        if converter and is_text(fname):
+            converted = converter.converted(view_name, fname, glob)
+            if converted:
+                rv[view_name] = view_for(view_name, converted, converted)
+                continue
+
+        # Parquet files carry their schema, so there's nothing to sniff.
+        columns = None
+        if catalog and is_text(fname):
+            columns = catalog.columns(view_name, fname, glob)
+
+        stmt = view_for(view_name, fname, glob, columns)
+        if stmt:
+            rv[view_name] = stmt
+    return rv
+
+def create_views(dirname):
+    return list(view_definitions(dirname).values())
+
+def view_globs(dirname):
+    """Returns a dict of view name -> the glob of the files the view reads."""
+    return {
+        view_name_for(view_name): glob
+        for view_name, fname, glob in discover_views(dirname)
+        if source_for(fname, glob)
+    }
 
-    return [x for x in rv if x]
+def parquet_globs(dirname):
+    """Returns a dict of view name -> glob for the Parquet-backed views."""
+    return {
+        view_name_for(view_name): glob
+        for view_name, fname, glob in discover_views(dirname)
+        if fname.endswith('.parquet')
+    }
@@ -1,103 +1,444 @@
 import asyncio
+import os
+import threading
 import duckdb
 from .debounce import debounce
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler, LoggingEventHandler
 from datasette.database import Database, Results
-from .ddl import create_views
-from .winging_it import ProxyConnection
+from .catalog import SchemaCatalog
+from .convert import ParquetConverter
+from .counts import ParquetCounts, fingerprint
+from .fts import SearchIndexes, is_sidecar
+from .export import DEFAULT_EXPORT_TIME_LIMIT_MS
+from .facets import facet_batch, DEFAULT_SUGGEST_SAMPLE_ROWS
+from .executor import PriorityExecutor, query_priority, priority_for
+from .ddl import view_definitions, view_globs, parquet_globs
+from .lru import LRUCache
+from .pool import ConnectionPool
+from .prepared import DEFAULT_STATEMENT_CACHE_SIZE, is_preparable
+from .rangecache import RangeCache, CachedHTTPFileSystem
+from .results import ResultCache, SchemaCache, referenced_tables
+from .shared import translate_shared
+from .singleflight import SingleFlight
+from .stats import QueryStats
+from .winging_it import ProxyConnection, bind, translate, DEFAULT_REWRITE_CACHE_SIZE
+
+DEFAULT_MAX_QUEUED = 100
+
+def duckdb_config(threads=None, memory_limit=None, temp_directory=None, object_cache=None):
+    """The config dict to pass to duckdb.connect, leaving unset options at
+    DuckDB's defaults.
+
+    These settings belong to the DuckDB instance, so the pooled cursors
+    share them with the connection they were made from."""
+    config = {}
+    if threads is not None:
+        config['threads'] = int(threads)
+    if memory_limit is not None:
+        config['memory_limit'] = str(memory_limit)
+    if temp_directory is not None:
+        config['temp_directory'] = temp_directory
+    if object_cache is not None:
+        config['enable_object_cache'] = object_cache == True
+    return config
+
+def range_cache_for(conn, directory, max_bytes, timeout=None, instance=None):
+    """Returns a RangeCache for directory, registered with conn's DuckDB
+    instance. Databases in a shared instance share its cache."""
+    if CachedHTTPFileSystem is None:
+        raise Exception('datasette-parquet: http_cache requires fsspec, try: pip install fsspec')
+
+    if instance and instance.range_cache:
+        return instance.range_cache
+
+    rv = RangeCache(directory, max_bytes, timeout=timeout)
+    conn.register_filesystem(CachedHTTPFileSystem(rv))
+    if instance:
+        instance.range_cache = rv
+    return rv
 
 class SchemaEventHandler(FileSystemEventHandler):
-    """React to files being added/removed from the watched directory."""
+    """React to files being added/removed from the watched directory.
+
+    Full-text index sidecars live next to the files they index, but writing
+    them doesn't change any view, so they're ignored."""
 
     def __init__(self, reload):
         super().__init__()
 
         self.reload = reload
 
+    def wanted(self, event):
+        paths = [event.src_path, getattr(event, 'dest_path', None)]
+        return not all(not path or is_sidecar(path) for path in paths)
+
     @debounce(1)
     def on_event(self):
         self.reload()
 
     def on_moved(self, event):
         super().on_moved(event)
-        self.on_event()
+        if self.wanted(event):
+            self.on_event()
 
     def on_created(self, event):
         super().on_created(event)
-        self.on_event()
+        if self.wanted(event):
+            self.on_event()
 
     def on_deleted(self, event):
         super().on_deleted(event)
-        self.on_event()
+        if self.wanted(event):
+            self.on_event()
 
     def on_modified(self, event):
         super().on_modified(event)
-        self.on_event()
+        if self.wanted(event):
+            self.on_event()
+
+def sync_views(conn, directory, current, catalog=None, converter=None):
+    """Create, replace and drop views in conn so that they match directory.
+
+    current is the dict of view name -> CREATE VIEW statement that conn has
+    now. The changes are made in a single transaction, so concurrent queries
+    see either the old views or the new ones. Queries that are already running
+    keep the definitions they were planned with.
+
+    If a SchemaCatalog is given, views use the column types it has on file,
+    and it's updated and saved. If a ParquetConverter is given, text files are
+    converted to Parquet, and their views use the Parquet copy once it's ready.
+
+    Returns the new dict of view definitions."""
+    wanted = view_definitions(directory, catalog, converter)
+
+    if catalog:
+        catalog.retain(wanted)
+        catalog.save()
+
+    stmts = []
+    for view_name in current:
+        if not view_name in wanted:
+            stmts.append('DROP VIEW "{}"'.format(view_name))
+
+    for view_name, stmt in wanted.items():
+        if current.get(view_name) != stmt:
+            stmts.append(stmt.replace('CREATE VIEW', 'CREATE OR REPLACE VIEW', 1))
 
-def create_directory_connection(directory):
-    raw_conn = duckdb.connect()
-    conn = ProxyConnection(raw_conn)
+    if not stmts:
+        return current
 
-    for create_view_stmt in create_views(directory):
-        conn.conn.execute(create_view_stmt)
+    conn.execute('BEGIN TRANSACTION')
+    try:
+        for stmt in stmts:
+            conn.execute(stmt)
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
 
-    return conn
+    return wanted
 
 class DuckDatabase(Database):
-    def __init__(self, ds, directory=None, file=None, httpfs=None, watch=None):
+    def __init__(self, ds, directory=None, file=None, httpfs=None, watch=None, rewrite_cache_size=None, statement_cache_size=None, pool_size=None, result_cache_bytes=None, catalog=None, parquet_cache=None, profile_threshold_ms=None, max_queued=None, suggest_sample_rows=None, threads=None, memory_limit=None, temp_directory=None, object_cache=None, instance=None, mount=None, fts=None, http_cache=None, http_cache_bytes=None, http_timeout_seconds=None, export_time_limit_ms=None):
         super().__init__(ds)
 
+        # Without limits, every database assumes it has the whole machine.
+        self.config = duckdb_config(threads, memory_limit, temp_directory, object_cache)
+
+        # Or it can share a DuckDB instance, and its limits, with others.
+        self.instance = instance
+        self.translate = translate
+        if instance:
+            self.config = instance.config
+            self.translate = translate_shared
+
         self.engine = 'duckdb'
+        self.file = None
+
+        # Rewrites only depend on the SQL text, so the cache outlives reloads.
+        if rewrite_cache_size is None:
+            rewrite_cache_size = DEFAULT_REWRITE_CACHE_SIZE
+        self.rewrite_cache = LRUCache(rewrite_cache_size)
+
+        # Each pooled connection prepares the statements it runs.
+        if statement_cache_size is None:
+            statement_cache_size = DEFAULT_STATEMENT_CACHE_SIZE
+
+        # One cursor per executor thread lets concurrent requests run in parallel.
+        if pool_size is None:
+            pool_size = ds.setting('num_sql_threads')
+        self.pool_size = pool_size
+
+        self.stats = QueryStats(profile_threshold_ms=profile_threshold_ms)
+
+        # Streamed CSV exports run as one query, with a limit of their own.
+        if export_time_limit_ms is None:
+            export_time_limit_ms = DEFAULT_EXPORT_TIME_LIMIT_MS
+        self.export_time_limit_ms = export_time_limit_ms
+
+        # Facet suggestions, keyed by the files behind them.
+        if suggest_sample_rows is None:
+            suggest_sample_rows = DEFAULT_SUGGEST_SAMPLE_ROWS
+        self.suggest_sample_rows = suggest_sample_rows
+        self.suggestion_cache = LRUCache(256)
+
+        # Introspection answers, until the views change.
+        self.schema_cache = SchemaCache()
+
+        # Identical queries that are running at the same time share one run.
+        self.in_flight = SingleFlight()
+
+        self.result_cache = None
+        if result_cache_bytes:
+            self.result_cache = ResultCache(result_cache_bytes, self.fingerprint_tables)
 
         if directory:
-            conn = create_directory_connection(directory)
+            self.catalog = SchemaCatalog(catalog, config=self.config) if catalog else None
+
+            # Counts are keyed by view, and check the files' fingerprints, so
+            # they can outlive reloads, too.
+            self.parquet_counts = ParquetCounts()
+
+            # Full-text indexes, for the views that want them.
+            self.search_indexes = None
+            if fts:
+                self.search_indexes = SearchIndexes(fts, self.parquet_counts, self.connect)
+
+            if instance:
+                raw_conn = instance.connect()
+                search_path = instance.mount_directory(mount)
+            else:
+                raw_conn = duckdb.connect(config=self.config)
+                search_path = None
+            conn = ProxyConnection(
+                raw_conn,
+                rewrite_cache=self.rewrite_cache,
+                parquet_counts=self.parquet_counts,
+                result_cache=self.result_cache,
+                schema_cache=self.schema_cache,
+                stats=self.stats,
+                statement_cache_size=statement_cache_size,
+                translate=self.translate,
+                search_path=search_path,
+                search_indexes=self.search_indexes
+            )
+            self.views = {}
+            reload_lock = threading.Lock()
 
             def reload():
-                self.conn.conn.close()
-                self.conn = create_directory_connection(directory)
+                # Only touch the views that changed, rather than reconnecting,
+                # so that running queries aren't disturbed.
+                with reload_lock:
+                    self.views = sync_views(conn.conn, directory, self.views, self.catalog, self.converter)
+                    self.view_globs = view_globs(directory)
+                    self.parquet_counts.set_globs(parquet_globs(directory))
+                    self.schema_cache.invalidate()
 
-            event_handler = SchemaEventHandler(reload)
-            observer = Observer()
-            observer.schedule(event_handler, directory, recursive=True)
-            observer.start()
+                    if self.search_indexes:
+                        self.search_indexes.refresh()
+
+                    if self.converter:
+                        self.converter.remove_retired()
+
+                    if self.result_cache:
+                        self.result_cache.clear()
+
+            # Conversions finish in the background, and then we move the
+            # views over to the Parquet copies.
+            self.converter = None
+            if parquet_cache:
+                self.converter = ParquetConverter(parquet_cache, on_converted=reload, config=self.config)
+
+            reload()
+            self.reload = reload
+
+            if watch:
+                event_handler = SchemaEventHandler(reload)
+                observer = Observer()
+                observer.schedule(event_handler, directory, recursive=True)
+                observer.start()
         elif file:
-            raw_conn = duckdb.connect(file, read_only=True)
-            conn = ProxyConnection(raw_conn)
+            self.file = file
+            self.search_indexes = None
+            if instance:
+                raw_conn = instance.connect()
+                search_path = instance.mount_file(mount, file)
+            else:
+                raw_conn = duckdb.connect(file, read_only=True, config=self.config)
+                search_path = None
+            conn = ProxyConnection(
+                raw_conn,
+                rewrite_cache=self.rewrite_cache,
+                result_cache=self.result_cache,
+                schema_cache=self.schema_cache,
+                stats=self.stats,
+                statement_cache_size=statement_cache_size,
+                translate=self.translate,
+                search_path=search_path
+            )
         else:
             raise Exception('must specify directory or file')
 
+        # Remote files are read through a local cache of their blocks. It has
+        # to be registered before httpfs, which would handle the URLs itself.
+        self.range_cache = None
+        if http_cache:
+            self.range_cache = range_cache_for(conn.conn, http_cache, http_cache_bytes, http_timeout_seconds, instance)
+
         if httpfs:
             conn.conn.execute('install httpfs;').fetchall()
             conn.conn.execute('load httpfs;').fetchall()
 
-        self.conn = conn
+        self.pool = ConnectionPool(conn, self.pool_size)
+
+        # Our own threads, one per pooled connection, so heavy DuckDB queries
+        # can't starve the SQLite databases of Datasette's executor.
+        if max_queued is None:
+            max_queued = DEFAULT_MAX_QUEUED
+        self.executor = PriorityExecutor(self.pool.size, max_queued)
+
+    def connect(self):
+        """A new DuckDB connection, for background work, with our limits."""
+        if self.instance:
+            return self.instance.connect()
+        return duckdb.connect(config=self.config)
+
+    @property
+    def conn(self):
+        return self.pool.root
+
+    def close(self):
+        self.executor.shutdown()
+        self.pool.close()
+
+    def summary(self, top=10):
+        """Query timings and cache statistics, for the /-/duckdb endpoint."""
+        rv = self.stats.summary(top)
+        rv['caches'] = {
+            'rewrite': self.rewrite_cache.stats(),
+            'result': self.result_cache.stats() if self.result_cache else None,
+            'schema': self.schema_cache.stats(),
+            'suggestions': self.suggestion_cache.stats(),
+            'search': self.search_indexes.stats() if self.search_indexes else None,
+            'http': self.range_cache.stats() if self.range_cache else None,
+        }
+        rv['in_flight'] = self.in_flight.stats()
+        return rv
+
+    def fingerprint_tables(self, tables):
+        """Returns a fingerprint of the files behind tables, or None."""
+        if self.file:
+            # Everything lives in the one (read-only) file.
+            st = os.stat(self.file)
+            return (st.st_mtime_ns, st.st_size)
+
+        rv = []
+        for table in sorted(tables):
+            glob = self.view_globs.get(table)
+            if glob is None:
+                return None
+            rv.append(fingerprint(glob))
+        return tuple(rv)
+
+    def fingerprint_sql(self, sql):
+        """Returns a fingerprint of the files behind a SQLite-dialect query,
+        or None."""
+        rewritten, _ = self.rewrite_cache.get_or_compute(sql, self.translate)
+        tables = referenced_tables(rewritten)
+        if tables is None:
+            return None
+        return self.fingerprint_tables(tables)
+
+    async def fts_table(self, table):
+        # Our views can't have FTS tables, but they can have indexes.
+        if self.search_indexes is None or not table in self.search_indexes.indexes:
+            return None
+
+        def in_thread(conn):
+            # Until it's indexed, searches say why they can't be answered,
+            # rather than being ignored.
+            if not self.search_indexes.searchable(table) or not self.parquet_counts.files(conn.conn, table):
+                return None
+            return self.search_indexes.fts_table(table)
+
+        return await self.execute_fn(in_thread)
+
+    async def table_columns(self, table):
+        if self.search_indexes:
+            view_name = self.search_indexes.view_for(table)
+            if view_name is not None:
+                return list(self.search_indexes.indexes[view_name])
+        return await super().table_columns(table)
 
     @property
     def size(self):
         # TODO: implement this? Not sure if it's useful.
         return 0
 
-    async def execute_fn(self, fn):
-        if self.ds.executor is None:
-            raise Exception('non-threaded mode not supported')
+    def flight_key(self, sql, params, truncate, custom_time_limit, page_size):
+        """Returns the key under which concurrent runs of a query are shared,
+        or None if it shouldn't be.
+
+        Queries with the same rewritten SQL and parameter values are the
+        same query. The time limit is part of the key, so nobody waits on a
+        query for longer than they would have run it themselves."""
+        try:
+            rewritten, names = self.rewrite_cache.get_or_compute(sql, self.translate)
+            values = tuple(bind(names, params))
+        except Exception:
+            # Running it normally will raise the error properly.
+            return None
+
+        if not is_preparable(rewritten):
+            return None
 
+        rv = (rewritten, values, truncate, custom_time_limit, page_size)
+        try:
+            hash(rv)
+        except TypeError:
+            return None
+        return rv
+
+    async def execute(self, sql, params=None, truncate=False, custom_time_limit=None, page_size=None, log_sql_errors=True):
+        batch = facet_batch.get()
+        if batch is not None:
+            results = batch.results_for(sql, params)
+            if results is not None:
+                return results
+
+        async def run():
+            token = query_priority.set(priority_for(sql))
+            try:
+                return await super(DuckDatabase, self).execute(
+                    sql,
+                    params,
+                    truncate=truncate,
+                    custom_time_limit=custom_time_limit,
+                    page_size=page_size,
+                    log_sql_errors=log_sql_errors
+                )
+            finally:
+                query_priority.reset(token)
+
+        key = self.flight_key(sql, params, truncate, custom_time_limit, page_size)
+        if key is None:
+            return await run()
+        return await self.in_flight.run(key, run)
+
+    async def execute_fn(self, fn):
         def in_thread():
-            return fn(self.conn)
+            return self.pool.run(fn)
 
-        return await asyncio.get_event_loop().run_in_executor(
-            self.ds.executor, in_thread
+        return await asyncio.wrap_future(
+            self.executor.submit(in_thread, query_priority.get())
         )
 
     async def execute_write_fn(self, fn, block=True):
-        if self.ds.executor is None:
-            raise Exception('non-threaded mode not supported')
-
         def in_thread():
-            return fn(self.conn)
+            return self.pool.run(fn)
 
         # We lie, we'll always block.
-        return await asyncio.get_event_loop().run_in_executor(
-            self.ds.executor, in_thread
+        return await asyncio.wrap_future(
+            self.executor.submit(in_thread, query_priority.get())
         )
-
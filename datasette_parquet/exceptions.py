@@ -1,3 +1,5 @@
+from datasette.views.base import DatasetteError
+
 class DoubleQuoteForLiteraValue(Exception):
     """
     DuckDB follows the SQL standard more closely than SQLite,
@@ -21,3 +23,17 @@ class DoubleQuoteForLiteraValue(Exception):
                 "strings instead."
         )
         super().__init__(matches)
+
+class QueryQueueFull(DatasetteError):
+    """
+    Thrown when a database already has as many queries waiting to run as
+    it's configured to allow. Rejecting work straight away keeps one busy
+    database from making every request to it time out.
+    """
+    def __init__(self, queued):
+        super().__init__(
+            "Too many queries are waiting to run against this database "
+            f"({queued} queued). Please try again shortly.",
+            title="Database busy",
+            status=503
+        )
@@ -0,0 +1,82 @@
+import contextvars
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future
+from . import exceptions
+
+# Lower numbers run first.
+PRIORITY_INTROSPECTION = 0
+PRIORITY_USER = 1
+
+# Set by DuckDatabase.execute for the duration of a query. Work that arrives
+# some other way is Datasette asking about tables and columns.
+query_priority = contextvars.ContextVar('query_priority', default=PRIORITY_INTROSPECTION)
+
+def priority_for(sql):
+    """Cheap catalog lookups jump ahead of queries over the data."""
+    stripped = sql.lstrip().upper()
+    if stripped.startswith('PRAGMA') or 'SQLITE_MASTER' in stripped:
+        return PRIORITY_INTROSPECTION
+    return PRIORITY_USER
+
+class PriorityExecutor:
+    """A fixed set of worker threads running work in priority order.
+
+    At most max_queued pieces of work can be waiting at once; beyond that,
+    submit() fails straight away rather than letting requests pile up."""
+
+    def __init__(self, workers, max_queued, name='datasette-parquet'):
+        self.max_queued = max_queued
+        self.cond = threading.Condition()
+        self.queue = []
+        self.counter = itertools.count()
+        self.shutting_down = False
+        self.threads = [
+            threading.Thread(target=self.run, name='{}-{}'.format(name, i), daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, fn, priority=PRIORITY_USER):
+        future = Future()
+        with self.cond:
+            if self.shutting_down:
+                raise RuntimeError('cannot submit work after shutdown')
+
+            if len(self.queue) >= self.max_queued:
+                raise exceptions.QueryQueueFull(len(self.queue))
+
+            # The counter keeps work of equal priority in arrival order.
+            heapq.heappush(self.queue, (priority, next(self.counter), future, fn))
+            self.cond.notify()
+        return future
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.shutting_down:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                _, _, future, fn = heapq.heappop(self.queue)
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                result = fn()
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def queued(self):
+        with self.cond:
+            return len(self.queue)
+
+    def shutdown(self):
+        with self.cond:
+            self.shutting_down = True
+            self.cond.notify_all()
@@ -0,0 +1,250 @@
+import asyncio
+import concurrent.futures
+import csv
+import io
+import re
+import sys
+import threading
+import uuid
+from datetime import date, time, timedelta
+from decimal import Decimal
+from time import perf_counter
+import sqlglot
+from datasette.utils import LimitedWriter, add_cors_headers
+from datasette.utils.asgi import AsgiStream, Request
+from .executor import PRIORITY_USER
+from .timelimit import watchdog
+
+try:
+    import pyarrow.csv as arrow_csv
+except ImportError:
+    arrow_csv = None
+
+EXPORT_BATCH_ROWS = 65536
+
+# How many encoded batches can wait for a slow client before the export
+# stops reading more.
+EXPORT_QUEUED_BATCHES = 4
+
+# An export runs one query for every page, so it gets longer than
+# sql_time_limit_ms, but it still has a limit.
+DEFAULT_EXPORT_TIME_LIMIT_MS = 60000
+
+# Column types that Arrow's CSV writer handles. Everything else is cast to
+# VARCHAR by DuckDB first, except BLOBs, which Datasette turns into links.
+arrow_types_re = re.compile(r'^(BOOLEAN|U?(TINYINT|SMALLINT|INTEGER|BIGINT)|HUGEINT|FLOAT|DOUBLE|DECIMAL\(\d+,\d+\)|VARCHAR|DATE)$')
+
+class ExportStopped(Exception):
+    """The response went away before the export finished."""
+
+def unlimited(sql):
+    """Removes the LIMIT and OFFSET from Datasette's SQL for a page of rows."""
+    expression = sqlglot.parse_one(sql, read='sqlite')
+    expression.set('limit', None)
+    expression.set('offset', None)
+    return expression.sql(dialect='sqlite')
+
+def quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+def export_sql(conn, sql, parameters):
+    """Wraps a DuckDB query so that Arrow can write each of its columns as
+    CSV. Returns None if it has BLOB columns."""
+    columns = []
+    for row in conn.execute('DESCRIBE {}'.format(sql), parameters).fetchall():
+        name, column_type = row[0], row[1]
+        if column_type == 'BLOB':
+            return None
+
+        if arrow_types_re.search(column_type):
+            columns.append(quote(name))
+        else:
+            columns.append('CAST({} AS VARCHAR) AS {}'.format(quote(name), quote(name)))
+
+    return 'SELECT {} FROM ({})'.format(', '.join(columns), sql)
+
+async def stream_csv(view, request, database, db):
+    """Streams every row of a table page as CSV, a record batch at a time.
+
+    Datasette's own streaming fetches a page at a time with _next, and
+    converts each row to Python objects to write it with the csv module.
+    Instead, we run the page's query once, without its LIMIT, and have
+    Arrow write each batch of DuckDB's results as CSV. The query runs as one
+    job on the database's executor, holding one of its pooled connections
+    until it's done, and is interrupted if it takes longer than the
+    database's export_time_limit_ms.
+
+    Returns None if the request isn't one we can handle."""
+    if arrow_csv is None or request.args.get('_trace') or request.args.get('_next') or not view.ds.setting('allow_csv_stream'):
+        return None
+
+    # As Datasette does: don't calculate facets or counts.
+    extra = ['{}=1'.format(key) for key in ('_nofacet', '_nocount') if not request.args.get(key)]
+    if extra:
+        query_string = '&'.join(([request.query_string] if request.query_string else []) + extra)
+        request = Request(dict(request.scope, query_string=query_string.encode('latin-1')), request.receive)
+
+    rv = await view.data(request)
+    if not isinstance(rv, tuple):
+        return None
+
+    data = rv[0]
+    if not data.get('table') or data.get('expanded_columns'):
+        return None
+
+    def run(fn):
+        return db.executor.submit(lambda: db.pool.run(fn), PRIORITY_USER)
+
+    def prepare(conn):
+        sql, parameters = conn.prepare(unlimited(data['query']['sql']), data['query']['params'])
+        return export_sql(conn.conn, sql, parameters), parameters
+
+    wrapped, parameters = await asyncio.wrap_future(run(prepare))
+    if wrapped is None:
+        return None
+
+    header = request.args.get('_header') != 'off'
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue(EXPORT_QUEUED_BATCHES)
+    stop = threading.Event()
+
+    def put(item):
+        """Hands item to the response, waiting while it's behind, unless the
+        response has gone away."""
+        future = asyncio.run_coroutine_threadsafe(chunks.put(item), loop)
+        while True:
+            try:
+                return future.result(0.1)
+            except concurrent.futures.TimeoutError:
+                if stop.is_set():
+                    future.cancel()
+                    raise ExportStopped()
+
+    def export(conn):
+        # One job, on one connection, for the whole export: a job per batch
+        # would need a free worker while holding a connection that other
+        # queued jobs are waiting for.
+        if stop.is_set():
+            return
+
+        deadline = perf_counter() + db.export_time_limit_ms / 1000
+        watchdog.watch(conn.conn, lambda: perf_counter() > deadline)
+        try:
+            reader = conn.conn.execute(wrapped, parameters).fetch_record_batch(EXPORT_BATCH_ROWS)
+            while not stop.is_set():
+                try:
+                    batch = reader.read_next_batch()
+                except StopIteration:
+                    break
+                put(encode(batch))
+            put(None)
+        except ExportStopped:
+            pass
+        except Exception as e:
+            put(e)
+        finally:
+            watchdog.unwatch(conn.conn)
+
+    def encode(batch):
+        out = io.BytesIO()
+        arrow_csv.write_csv(batch, out, arrow_csv.WriteOptions(include_header=False, eol='\r\n'))
+        return out.getvalue().decode('utf-8')
+
+    def encode_header():
+        out = io.StringIO()
+        csv.writer(out).writerow(data['columns'])
+        return out.getvalue()
+
+    async def stream_fn(r):
+        writer = LimitedWriter(r, view.ds.setting('max_csv_mb'))
+        job = None
+        try:
+            if header:
+                await writer.write(encode_header())
+
+            job = asyncio.wrap_future(run(export))
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                await writer.write(chunk)
+        except Exception as e:
+            sys.stderr.write('Caught this error: {}\n'.format(e))
+            sys.stderr.flush()
+            await r.write(str(e))
+        finally:
+            # The connection goes back to the pool when the job ends, so
+            # make sure it has before we do.
+            stop.set()
+            if job is not None:
+                await asyncio.gather(job, return_exceptions=True)
+
+    headers = {}
+    if view.ds.cors:
+        add_cors_headers(headers)
+
+    content_type = 'text/plain; charset=utf-8'
+    if request.args.get('_dl', None):
+        content_type = 'text/csv; charset=utf-8'
+        headers['content-disposition'] = 'attachment; filename="{}.csv"'.format(
+            request.url_vars.get('table', database)
+        )
+
+    return AsgiStream(stream_fn, headers=headers, content_type=content_type)
+
+def jsonable(value):
+    """Converts a value from DuckDB into something json.dumps can handle."""
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (uuid.UUID, timedelta)):
+        return str(value)
+    if isinstance(value, (list, tuple)):
+        return [jsonable(x) for x in value]
+    if isinstance(value, dict):
+        return {str(k): jsonable(v) for k, v in value.items()}
+    return value
+
+def converter_for(column):
+    """Returns a function to make the values of column JSON-friendly, or
+    None if they already are. A DuckDB column has one type, so the first
+    value that isn't NULL tells us what the rest are."""
+    for value in column:
+        if value is None:
+            continue
+        if isinstance(value, (str, int, float, bool, bytes)):
+            return None
+        if isinstance(value, (date, time)):
+            return lambda v: v.isoformat()
+        return jsonable
+    return None
+
+def jsonable_rows(rows):
+    """Converts rows to lists of JSON-friendly values, a column at a time.
+
+    This saves json.dumps from calling back into Python for every row and
+    every date it meets."""
+    if not rows:
+        return rows
+
+    columns = list(zip(*rows))
+    for i, column in enumerate(columns):
+        convert = converter_for(column)
+        if convert:
+            columns[i] = [None if v is None else convert(v) for v in column]
+
+    return [list(row) for row in zip(*columns)]
+
+def json_renderer(original):
+    """Wraps Datasette's JSON renderer to convert DuckDB rows column-wise."""
+    from .ducky import DuckDatabase
+
+    def render(args, data, view_name, datasette, database):
+        if isinstance(datasette.databases.get(database), DuckDatabase) and data.get('rows'):
+            data['rows'] = jsonable_rows(data['rows'])
+        return original(args, data, view_name)
+
+    return render
@@ -0,0 +1,209 @@
+import contextvars
+import re
+from datasette.database import QueryInterrupted, Results
+from datasette.utils import escape_sqlite, path_with_added_args
+from .winging_it import ColumnIndex, Row
+
+# Set while Datasette runs the column facets for a table page, so that
+# DuckDatabase.execute can answer each facet's query from the batch.
+facet_batch = contextvars.ContextVar('facet_batch', default=None)
+
+whitespace_re = re.compile(r'\s+')
+
+# The query Datasette's ColumnFacet runs for each facet, with its whitespace
+# squashed.
+facet_sql_re = re.compile(
+    r'^select (.+?) as value, count\(\*\) as count from \( (.*) \) '
+    r'where \1 is not null group by \1 order by count desc, value limit (\d+)$',
+    re.S
+)
+
+DEFAULT_SUGGEST_SAMPLE_ROWS = 100000
+
+FACET_DESCRIPTION = (('value',), ('count',))
+FACET_COLUMNS = ColumnIndex(['value', 'count'])
+
+def squash(sql):
+    return whitespace_re.sub(' ', sql).strip()
+
+class FacetBatch:
+    """Several column facets over the same query, computed in one scan.
+
+    Datasette runs one GROUP BY per facet, each of which scans the table
+    again. Instead, we group by all of the facet columns at once with
+    GROUPING SETS, keep the top limit values of each, and hand each facet
+    query its slice."""
+
+    def __init__(self, sql, params, columns, limit):
+        self.sql = squash(sql)
+        self.params = params
+        self.limit = limit
+        self.columns = []
+        for column in columns:
+            escaped = escape_sqlite(column)
+            if not escaped in self.columns:
+                self.columns.append(escaped)
+
+        self.results = None
+        self.interrupted = False
+
+    def query(self):
+        columns = ', '.join(self.columns)
+        grouped = 'select grouping_id({cols}) as _grouping, {cols}, count(*) as count from ({sql}) group by grouping sets ({sets})'.format(
+            cols=columns,
+            sql=self.sql,
+            sets=', '.join('({})'.format(c) for c in self.columns)
+        )
+
+        # Within each grouping set, the other columns are all NULL, so
+        # ordering by every column orders by the one that was grouped. The
+        # outer query has to order the rows again: the window's order isn't
+        # kept.
+        return 'select * from (select *, row_number() over (partition by _grouping order by count desc, {cols}) as _rank from ({grouped}) where {not_null}) where _rank <= {limit} order by _grouping, _rank'.format(
+            cols=columns,
+            grouped=grouped,
+            not_null=' or '.join('{} is not null'.format(c) for c in self.columns),
+            limit=self.limit
+        )
+
+    def load(self, rows):
+        # GROUPING_ID has a bit set for each column left out of the set, with
+        # the first column as the most significant bit.
+        n = len(self.columns)
+        by_grouping = {
+            ((1 << n) - 1) ^ (1 << (n - 1 - i)): i
+            for i in range(n)
+        }
+
+        self.results = {column: [] for column in self.columns}
+        for row in rows:
+            i = by_grouping[row[0]]
+            self.results[self.columns[i]].append(Row(FACET_COLUMNS, (row[1 + i], row[1 + n])))
+
+    def results_for(self, sql, params):
+        """Returns the Results for one facet's query, or None if it's not
+        one of ours."""
+        if self.results is None and not self.interrupted:
+            return None
+
+        m = facet_sql_re.search(squash(sql))
+        if not m or m.group(2) != self.sql or int(m.group(3)) != self.limit or params != self.params:
+            return None
+
+        column = m.group(1)
+        if not column in self.columns:
+            return None
+
+        if self.interrupted:
+            raise QueryInterrupted(None, sql, params)
+
+        return Results(self.results[column], False, FACET_DESCRIPTION)
+
+async def run_batch(facet, columns):
+    """Computes the facets for columns in one query, returning the batch, or
+    None if they can't be computed together."""
+    columns = list(columns)
+    if len(columns) < 2:
+        return None
+
+    batch = FacetBatch(facet.sql, facet.params, columns, facet.get_facet_size() + 1)
+    try:
+        results = await facet.ds.execute(
+            facet.database,
+            batch.query(),
+            facet.params,
+            truncate=False,
+            # The time that the facets would have had between them.
+            custom_time_limit=facet.ds.setting('facet_time_limit_ms') * len(batch.columns),
+        )
+    except QueryInterrupted:
+        batch.interrupted = True
+        return batch
+    except Exception:
+        # Leave it to the individual queries to succeed or fail.
+        return None
+
+    batch.load(results.rows)
+    return batch
+
+def suggest_sql(sql, columns, sample_rows):
+    # LIMIT is the only kind of sample that stops DuckDB reading early:
+    # USING SAMPLE still scans everything. For Parquet, this reads the
+    # leading row groups.
+    return 'select count(*), {} from (select * from ({}) limit {})'.format(
+        ', '.join('approx_count_distinct({})'.format(escape_sqlite(c)) for c in columns),
+        sql,
+        sample_rows
+    )
+
+async def suggest_columns(facet, db):
+    """Returns the columns worth faceting by for facet's query, or None if
+    we couldn't tell.
+
+    Rather than grouping by each column in turn over the whole query, we
+    estimate every column's distinct values in one pass over a bounded
+    sample. The answer is cached until the files behind the query change."""
+    facet_size = facet.get_facet_size()
+    params = facet.params
+    if isinstance(params, dict):
+        params = tuple(sorted(params.items()))
+    else:
+        params = tuple(params)
+
+    fp = db.fingerprint_sql(facet.sql)
+    key = (facet.sql, params, facet_size, fp)
+    if fp is not None:
+        cached = db.suggestion_cache.get(key)
+        if cached is not None:
+            return cached
+
+    columns = await facet.get_columns(facet.sql, facet.params)
+    if not columns:
+        return []
+
+    try:
+        results = await facet.ds.execute(
+            facet.database,
+            suggest_sql(facet.sql, columns, db.suggest_sample_rows),
+            facet.params,
+            truncate=False,
+            custom_time_limit=facet.ds.setting('facet_suggest_time_limit_ms') * len(columns),
+        )
+    except QueryInterrupted:
+        # Don't remember this: it may be quicker next time.
+        return []
+    except Exception:
+        return None
+
+    row = results.first()
+    sampled = row[0]
+    rv = [
+        column
+        for column, distinct in zip(columns, row[1:])
+        # Some values repeat, but not too many of them.
+        if 1 < distinct <= facet_size and distinct < sampled
+    ]
+
+    if fp is not None:
+        db.suggestion_cache.put(key, rv)
+    return rv
+
+async def suggest(facet, db):
+    columns = await suggest_columns(facet, db)
+    if columns is None:
+        return None
+
+    already_enabled = [c['config']['simple'] for c in facet.get_configs()]
+    return [
+        {
+            'name': column,
+            'toggle_url': facet.ds.absolute_url(
+                facet.request,
+                facet.ds.urls.path(
+                    path_with_added_args(facet.request, {'_facet': column})
+                ),
+            ),
+        }
+        for column in columns
+        if not column in already_enabled
+    ]
@@ -0,0 +1,349 @@
+import glob
+import hashlib
+import os
+import re
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from .counts import quote_string
+from .ddl import is_recursive
+from .lru import LRUCache
+
+# What rewrite() turns Datasette's ?_search= clauses into: the FTS table,
+# the column being searched ('' for all of them), the parameter holding the
+# search and whether it's in raw mode.
+fts_marker_re = re.compile(r"DATASETTE_FTS_MATCH\('((?:[^']|'')*)', '((?:[^']|'')*)', \$(\d+), (0|1)\)")
+
+# Words, as the index splits them: runs of letters and numbers.
+word_re = re.compile(r'[^\W_]+(\*?)')
+TOKENIZE_SQL = r"regexp_split_to_array(lower(CAST({} AS VARCHAR)), '[^\p{{L}}\p{{N}}]+')"
+
+# Hits that are further apart than this are read as separate ranges, so the
+# row groups between them can be skipped.
+MAX_GAP = 65536
+MAX_RANGES = 32
+
+# Beyond this, the rows are matched with a join against the index rather
+# than listed in the query.
+MAX_LISTED_ROWS = 10000
+
+def quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+# Any sidecar, or one that's being written.
+any_sidecar_re = re.compile(r'\.[0-9a-f]{16}\.fts(\.tmp)?$')
+
+def is_sidecar(path):
+    return any_sidecar_re.search(path) is not None
+
+def sidecar_re(fname):
+    return re.compile(re.escape(fname) + r'\.[0-9a-f]{16}\.fts$')
+
+def terms_for(search, raw):
+    """Returns the (word, is_prefix) pairs a row must contain to match.
+
+    In raw mode, a word ending in * matches any word it's a prefix of."""
+    rv = []
+    for m in word_re.finditer(search.lower()):
+        term = (m.group(0).rstrip('*'), raw and m.group(1) == '*')
+        if not term in rv:
+            rv.append(term)
+    return rv
+
+def term_condition(term):
+    word, prefix = term
+    if prefix:
+        # The next string after every string that starts with word.
+        return 'term >= {} AND term < {}'.format(quote_string(word), quote_string(word[:-1] + chr(ord(word[-1]) + 1)))
+    return 'term = {}'.format(quote_string(word))
+
+def ranges(rows):
+    """Splits sorted row numbers into (first, last) ranges."""
+    rv = []
+    for row in rows:
+        if rv and row - rv[-1][1] <= MAX_GAP:
+            rv[-1][1] = row
+        else:
+            rv.append([row, row])
+
+    if len(rv) > MAX_RANGES:
+        return [(rows[0], rows[-1])]
+    return [tuple(r) for r in rv]
+
+class SearchIndexes:
+    """Full-text indexes for Parquet views, to answer Datasette's ?_search=.
+
+    indexes is a dict of view name -> the columns to index. Each of the
+    view's files gets a sidecar Parquet file next to it, listing every word
+    in those columns with the column and file_row_number it's in, sorted by
+    word. A search looks its words up in the sidecars, which DuckDB can do
+    from the row group statistics, and then reads only the rows that
+    matched.
+
+    Sidecars are named after a hash of the columns and the data file's mtime
+    and size, so they're built again, one file at a time, when a file
+    changes. They're built in the background; until every file of a view has
+    one, searching the view raises an error saying that its index is being
+    built, or why it couldn't be. A build that fails is tried again on the
+    next refresh.
+
+    counts is the database's ParquetCounts, which knows the view's files in
+    the order DuckDB reads them. connect returns a new DuckDB connection, for
+    finding and indexing the files."""
+
+    def __init__(self, indexes, counts, connect):
+        self.indexes = indexes
+        self.counts = counts
+        self.connect = connect
+        self.lock = threading.Lock()
+        self.scan = None
+        self.pending = {}
+        self.failed = {}
+        self.hits = LRUCache(256)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='datasette-parquet-fts')
+
+    def fts_table(self, view_name):
+        return '{}_fts'.format(view_name)
+
+    def view_for(self, fts_table):
+        for view_name in self.indexes:
+            if self.fts_table(view_name) == fts_table:
+                return view_name
+        return None
+
+    def sidecar_for(self, view_name, fname):
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return None
+
+        key = (self.indexes[view_name], st.st_mtime_ns, st.st_size)
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+        return '{}.{}.fts'.format(fname, digest)
+
+    def searchable(self, view_name):
+        """Whether we can index view_name: Parquet, and not partitioned."""
+        pattern = self.counts.globs.get(view_name)
+        return pattern is not None and not is_recursive(pattern)
+
+    def files(self, conn, view_name):
+        """Returns a list of (file name, sidecar) for view_name, in the order
+        DuckDB reads the files, or None if any of them isn't indexed yet."""
+        if not view_name in self.indexes or not self.searchable(view_name):
+            return None
+
+        files = self.counts.files(conn, view_name)
+        if not files:
+            return None
+
+        rv = []
+        for fname, _ in files:
+            sidecar = self.sidecar_for(view_name, fname)
+            if sidecar is None or not os.path.exists(sidecar):
+                return None
+            rv.append((fname, sidecar))
+        return rv
+
+    def refresh(self):
+        """Starts indexing, in the background, any files that don't have a
+        current sidecar."""
+        with self.lock:
+            # Failed builds get another go.
+            self.failed = {}
+            self.scan = self.executor.submit(self.find_unindexed)
+
+    def find_unindexed(self):
+        conn = self.connect()
+        try:
+            for view_name in self.indexes:
+                if not self.searchable(view_name):
+                    continue
+
+                for fname, _ in self.counts.files(conn, view_name) or []:
+                    sidecar = self.sidecar_for(view_name, fname)
+                    if sidecar is None or os.path.exists(sidecar):
+                        continue
+
+                    with self.lock:
+                        if not sidecar in self.pending and not sidecar in self.failed:
+                            self.pending[sidecar] = self.executor.submit(self.build, view_name, fname, sidecar)
+        finally:
+            conn.close()
+
+    def build(self, view_name, fname, sidecar):
+        words = ' UNION ALL '.join(
+            'SELECT {} AS "column", file_row_number AS row, unnest({}) AS term FROM read_parquet({}, file_row_number=true)'.format(
+                quote_string(column),
+                TOKENIZE_SQL.format(quote(column)),
+                quote_string(fname)
+            )
+            for column in self.indexes[view_name]
+        )
+
+        tmp = '{}.tmp'.format(sidecar)
+        try:
+            conn = self.connect()
+            try:
+                conn.execute("COPY (SELECT DISTINCT term, \"column\", row FROM ({}) WHERE term <> '' ORDER BY term, row) TO {} (FORMAT PARQUET)".format(
+                    words,
+                    quote_string(tmp)
+                ))
+            finally:
+                conn.close()
+            os.replace(tmp, sidecar)
+        except Exception as e:
+            sys.stderr.write('datasette-parquet: failed to index {}: {}\n'.format(fname, e))
+            sys.stderr.flush()
+            with self.lock:
+                self.failed[sidecar] = '{}: {}'.format(fname, e)
+                del self.pending[sidecar]
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            return
+
+        with self.lock:
+            del self.pending[sidecar]
+
+        self.remove_stale(fname, sidecar)
+
+    def remove_stale(self, fname, sidecar):
+        stale_re = sidecar_re(fname)
+        for f in glob.glob(glob.escape(fname) + '.*.fts'):
+            if f != sidecar and stale_re.search(f):
+                os.remove(f)
+
+    def wait(self):
+        """Blocks until all the indexing started so far has finished."""
+        with self.lock:
+            scan = self.scan
+        if scan:
+            scan.result()
+
+        with self.lock:
+            futures = list(self.pending.values())
+        wait(futures)
+
+    def failure(self, conn, view_name):
+        """Returns why view_name's index couldn't be built, or None."""
+        with self.lock:
+            if not self.failed:
+                return None
+
+        for fname, _ in self.counts.files(conn, view_name) or []:
+            with self.lock:
+                error = self.failed.get(self.sidecar_for(view_name, fname))
+            if error:
+                return error
+        return None
+
+    def stats(self):
+        rv = self.hits.stats()
+        with self.lock:
+            rv['building'] = len(self.pending)
+            rv['failed'] = sorted(self.failed.values())
+        return rv
+
+    def matching_rows(self, conn, sidecar, searches):
+        """Returns the sorted row numbers in sidecar's file that match every
+        one of searches, a list of (column, terms)."""
+        key = (sidecar, tuple(searches))
+        cached = self.hits.get(key)
+        if cached is not None:
+            return cached
+
+        rv = None
+        for sql in self.lookups_sql(sidecar, searches):
+            rows = {row for row, in conn.execute(sql).fetchall()}
+            rv = rows if rv is None else rv & rows
+            if not rv:
+                break
+
+        rv = sorted(rv or ())
+        self.hits.put(key, rv)
+        return rv
+
+    def lookups_sql(self, sidecar, searches):
+        """One query per term, for the rows of sidecar's file that have it."""
+        rv = []
+        for column, terms in searches:
+            for term in terms:
+                sql = 'SELECT row FROM read_parquet({}) WHERE {}'.format(quote_string(sidecar), term_condition(term))
+                if column:
+                    sql += ' AND "column" = {}'.format(quote_string(column))
+                rv.append(sql)
+        return rv
+
+    def rows_sql(self, fname, sidecar, searches, rows, part):
+        """A query for the matching rows of one file."""
+        where = ' OR '.join(
+            'file_row_number BETWEEN {} AND {}'.format(first, last)
+            for first, last in ranges(rows)
+        )
+
+        if len(rows) <= MAX_LISTED_ROWS:
+            matching = ', '.join(str(row) for row in rows)
+        else:
+            matching = ' INTERSECT '.join(self.lookups_sql(sidecar, searches))
+
+        return 'SELECT *, {} AS datasette_part FROM read_parquet({}, file_row_number=true) WHERE ({}) AND file_row_number IN ({})'.format(
+            part,
+            quote_string(fname),
+            where,
+            matching
+        )
+
+    def relation_sql(self, conn, view_name, searches):
+        """A query for the rows of view_name that match every one of
+        searches, or None if it isn't indexed."""
+        files = self.files(conn, view_name)
+        if files is None:
+            return None
+
+        parts = []
+        # A search with no words matches nothing, as it does in SQLite.
+        if all(terms for _, terms in searches):
+            for fname, sidecar in files:
+                rows = self.matching_rows(conn, sidecar, searches)
+                if rows:
+                    parts.append(self.rows_sql(fname, sidecar, searches, rows, len(parts)))
+
+        if not parts:
+            return 'SELECT * EXCLUDE (file_row_number) FROM read_parquet({}, file_row_number=true) LIMIT 0'.format(quote_string(files[0][0]))
+
+        return 'SELECT * EXCLUDE (file_row_number, datasette_part) FROM ({}) ORDER BY datasette_part, file_row_number'.format(
+            ' UNION ALL '.join(parts)
+        )
+
+    def rewrite(self, conn, sql, parameters):
+        """Returns sql with its searches answered from the indexes, or None
+        if it doesn't have any."""
+        matches = list(fts_marker_re.finditer(sql))
+        if not matches:
+            return None
+
+        # Datasette only searches one table at a time.
+        fts_table = matches[0].group(1).replace("''", "'")
+        view_name = self.view_for(fts_table)
+        if view_name is None:
+            raise sqlite3.OperationalError('no such table: {}'.format(fts_table))
+
+        searches = []
+        for m in matches:
+            search = parameters[int(m.group(3)) - 1]
+            searches.append((m.group(2).replace("''", "'"), tuple(terms_for(str(search or ''), m.group(4) == '1'))))
+
+        relation = self.relation_sql(conn, view_name, searches)
+        if relation is None:
+            error = self.failure(conn, view_name)
+            if error:
+                raise sqlite3.OperationalError('the full-text index for {} could not be built: {}'.format(view_name, error))
+            raise sqlite3.OperationalError('the full-text index for {} is being rebuilt'.format(view_name))
+
+        # The search parameters are still bound, so they have to stay in
+        # the query.
+        sql = fts_marker_re.sub(lambda m: '(${} IS NOT NULL)'.format(m.group(3)), sql)
+
+        # Read the view from the matching rows alone.
+        view_re = re.compile(r'\b(FROM|JOIN) ({}|{})(?=[\s),]|$)'.format(re.escape(quote(view_name)), re.escape(view_name)))
+        return view_re.sub(lambda m: '{} ({}) AS {}'.format(m.group(1), relation, quote(view_name)), sql)
@@ -0,0 +1,86 @@
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    """A size-bounded, thread-safe least-recently-used cache.
+
+    By default, maxsize is a number of entries. If a weigher is given, it's
+    called with each value, and maxsize bounds the sum of their weights
+    instead (e.g. bytes).
+
+    If on_evict is given, it's called with each key and value that's
+    evicted to make room for others.
+
+    Tracks hits and misses so callers can report how effective it is."""
+
+    def __init__(self, maxsize=1024, weigher=None, on_evict=None):
+        self.maxsize = maxsize
+        self.weigher = weigher
+        self.on_evict = on_evict
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, _ = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        weight = self.weigher(value) if self.weigher else 1
+        if weight > self.maxsize:
+            return
+
+        evicted = []
+        with self.lock:
+            old = self.data.pop(key, None)
+            if old:
+                self.size -= old[1]
+
+            self.data[key] = (value, weight)
+            self.size += weight
+
+            while self.size > self.maxsize:
+                evicted_key, (evicted_value, evicted_weight) = self.data.popitem(last=False)
+                self.size -= evicted_weight
+                evicted.append((evicted_key, evicted_value))
+
+        if self.on_evict:
+            for evicted_key, evicted_value in evicted:
+                self.on_evict(evicted_key, evicted_value)
+
+    def get_or_compute(self, key, fn):
+        # Two threads may race to compute the same key; that's fine, the
+        # values are equivalent and the last one wins.
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = fn(key)
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': self.size,
+                'maxsize': self.maxsize,
+            }
+
+    def __len__(self):
+        return len(self.data)
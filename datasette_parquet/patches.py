@@ -1,4 +1,6 @@
 from datetime import date
+from .export import stream_csv
+from .facets import facet_batch, run_batch, suggest
 from .winging_it import Row
 
 def monkey_patch():
@@ -20,4 +22,65 @@ def monkey_patch():
 
     CustomJSONEncoder.default = patched_default
 
+    from datasette.facets import ColumnFacet
 
+    # startup runs once per Datasette instance, but we only want to batch once.
+    if getattr(ColumnFacet.facet_results, 'batched', False):
+        return
+
+    original_facet_results = ColumnFacet.facet_results
+
+    async def patched_facet_results(self):
+        # Compute all of a page's column facets in one scan of a DuckDB
+        # database, then let Datasette's code run as usual, with each of its
+        # facet queries answered from the batch.
+        from .ducky import DuckDatabase
+
+        if not isinstance(self.ds.get_database(self.database), DuckDatabase):
+            return await original_facet_results(self)
+
+        configs = self.get_configs()
+        batch = await run_batch(self, [c['config'].get('column') or c['config']['simple'] for c in configs])
+        token = facet_batch.set(batch)
+        try:
+            return await original_facet_results(self)
+        finally:
+            facet_batch.reset(token)
+
+    patched_facet_results.batched = True
+    ColumnFacet.facet_results = patched_facet_results
+
+    original_suggest = ColumnFacet.suggest
+
+    async def patched_suggest(self):
+        # Suggest facets from a sample, rather than grouping by every column.
+        from .ducky import DuckDatabase
+
+        db = self.ds.get_database(self.database)
+        if isinstance(db, DuckDatabase):
+            rv = await suggest(self, db)
+            if rv is not None:
+                return rv
+
+        return await original_suggest(self)
+
+    ColumnFacet.suggest = patched_suggest
+
+    from datasette.views.base import DataView
+
+    original_as_csv = DataView.as_csv
+
+    async def patched_as_csv(self, request, database):
+        # Stream whole tables straight from DuckDB, rather than a page at a time.
+        from .ducky import DuckDatabase
+
+        if request.args.get('_stream'):
+            db = self.ds.get_database(route=database)
+            if isinstance(db, DuckDatabase):
+                rv = await stream_csv(self, request, database, db)
+                if rv is not None:
+                    return rv
+
+        return await original_as_csv(self, request, database)
+
+    DataView.as_csv = patched_as_csv
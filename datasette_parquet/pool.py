@@ -0,0 +1,81 @@
+import sqlite3
+import threading
+
+class PoolClosed(sqlite3.ProgrammingError):
+    """Raised when acquiring from a pool that has been closed, such as by
+    queries that were still queued when their database was closed.
+
+    It's the error sqlite3 raises for a closed connection, so Datasette
+    reports it like one."""
+
+    def __init__(self):
+        super().__init__('Cannot operate on a closed database.')
+
+class ConnectionPool:
+    """A fixed-size pool of DuckDB cursors that share one database.
+
+    DuckDB cursors are independent connections to the same database instance,
+    so they see the same views and can run queries in parallel.
+
+    Closing the root connection closes every cursor derived from it, so
+    close() only tears down idle cursors; cursors that are checked out are
+    closed when they're released, and the root goes with the last of them."""
+
+    def __init__(self, root, size):
+        self.root = root
+        self.size = max(1, size)
+        self.live = 0
+        self.idle = []
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise PoolClosed()
+
+                if self.idle:
+                    return self.idle.pop()
+
+                if self.live < self.size:
+                    self.live += 1
+                    return self.root.duplicate()
+
+                self.cond.wait()
+
+    def release(self, conn):
+        with self.cond:
+            if not self.closed:
+                self.idle.append(conn)
+                self.cond.notify()
+                return
+
+            conn.close()
+            self.live -= 1
+            if self.live == 0:
+                self.root.close()
+
+    def run(self, fn):
+        conn = self.acquire()
+        try:
+            return fn(conn)
+        finally:
+            self.release(conn)
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+
+            self.closed = True
+
+            for conn in self.idle:
+                conn.close()
+            self.live -= len(self.idle)
+            self.idle = []
+
+            if self.live == 0:
+                self.root.close()
+
+            self.cond.notify_all()
@@ -0,0 +1,91 @@
+import itertools
+import math
+import duckdb
+from .lru import LRUCache
+
+DEFAULT_STATEMENT_CACHE_SIZE = 256
+
+# Marks SQL that DuckDB wouldn't prepare, so we don't keep trying.
+UNPREPARABLE = ''
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+def literal(value):
+    """Renders value as a DuckDB SQL literal, or returns None if we can't be
+    sure of doing so safely."""
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        if INT64_MIN <= value <= INT64_MAX:
+            return '{}::BIGINT'.format(value)
+        return None
+    if isinstance(value, float):
+        if math.isfinite(value):
+            # Otherwise, 0.1 would be a DECIMAL.
+            return '{!r}::DOUBLE'.format(value)
+        return None
+    if isinstance(value, str):
+        if '\0' in value:
+            return None
+        return "'{}'".format(value.replace("'", "''"))
+    return None
+
+def is_preparable(sql):
+    stripped = sql.lstrip()[:6].upper()
+    return stripped.startswith('SELECT') or stripped.startswith('WITH')
+
+class PreparedStatements:
+    """Prepared statements for one DuckDB connection, keyed by their SQL.
+
+    Datasette runs the same handful of queries over and over with different
+    parameters. Preparing each once saves DuckDB from parsing, binding and
+    planning it on every request.
+
+    DuckDB's Python API doesn't expose prepared statements, so we use SQL's
+    PREPARE and EXECUTE. EXECUTE only accepts literals, so the parameters are
+    rendered as literals; queries with parameters that can't be rendered
+    safely are run the usual way.
+
+    A connection must only be used by one thread at a time, so neither is
+    this."""
+
+    def __init__(self, conn, size=DEFAULT_STATEMENT_CACHE_SIZE):
+        self.conn = conn
+        self.counter = itertools.count()
+        self.names = LRUCache(size, on_evict=self.deallocate)
+
+    def deallocate(self, sql, name):
+        if name != UNPREPARABLE:
+            self.conn.execute('DEALLOCATE {}'.format(name))
+
+    def name_for(self, sql):
+        name = self.names.get(sql)
+        if name is not None:
+            return name
+
+        name = UNPREPARABLE
+        if is_preparable(sql):
+            name = 'datasette_parquet_{}'.format(next(self.counter))
+            try:
+                self.conn.execute('PREPARE {} AS {}'.format(name, sql))
+            except duckdb.Error:
+                # Running it normally will raise the error properly.
+                name = UNPREPARABLE
+
+        self.names.put(sql, name)
+        return name
+
+    def execute(self, sql, parameters):
+        if self.names.maxsize:
+            name = self.name_for(sql)
+            if name != UNPREPARABLE:
+                args = [literal(value) for value in parameters or []]
+                if not None in args:
+                    if args:
+                        return self.conn.execute('EXECUTE {}({})'.format(name, ', '.join(args)))
+                    return self.conn.execute('EXECUTE {}'.format(name))
+
+        return self.conn.execute(sql, parameters)
@@ -0,0 +1,275 @@
+import hashlib
+import os
+import re
+import threading
+import time
+import urllib.request
+from .lru import LRUCache
+
+try:
+    from fsspec.spec import AbstractFileSystem, AbstractBufferedFile
+except ImportError:
+    AbstractFileSystem = None
+
+DEFAULT_HTTP_CACHE_BYTES = 1024 * 1024 * 1024
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+# How long to trust what the server told us about a file before asking it
+# again. DuckDB looks up a file's size several times per query, so this
+# saves a round trip for each of them.
+DEFAULT_REVALIDATE_SECONDS = 60
+
+# Reads happen inside DuckDB, where a query can't be interrupted, so a server
+# that stops responding mustn't hold on to the query forever.
+DEFAULT_HTTP_TIMEOUT_SECONDS = 30
+
+content_range_re = re.compile(r'^bytes \d+-\d+/(\d+)$')
+
+block_re = re.compile(r'^[0-9a-f]{40}\.\d+$')
+
+class RemoteFile:
+    def __init__(self, url, size, validator):
+        self.url = url
+        self.size = size
+        self.validator = validator
+
+def validator_for(headers):
+    """The ETag, or failing that the Last-Modified date, of a response."""
+    return headers.get('ETag') or headers.get('Last-Modified')
+
+class RangeCache:
+    """A persistent, size-bounded cache of blocks of remote files.
+
+    Parquet readers fetch the footer and then the column chunks they need, as
+    byte ranges. Without a cache, every query fetches them again. Instead,
+    files are read in blocks of block_size bytes, which are kept in
+    directory, and evicted least-recently-used first once they add up to
+    more than max_bytes. The blocks survive restarts.
+
+    Blocks are named after the URL and the file's ETag (or Last-Modified
+    date), so when the file changes, its old blocks are never read again,
+    and age out. The server is asked whether the file changed at most every
+    revalidate_seconds. Files that have neither header can't be validated,
+    so they're read without caching."""
+
+    def __init__(self, directory, max_bytes=None, block_size=DEFAULT_BLOCK_SIZE, revalidate_seconds=DEFAULT_REVALIDATE_SECONDS, timeout=None):
+        if max_bytes is None:
+            max_bytes = DEFAULT_HTTP_CACHE_BYTES
+        if timeout is None:
+            timeout = DEFAULT_HTTP_TIMEOUT_SECONDS
+
+        self.directory = directory
+        self.block_size = block_size
+        self.revalidate_seconds = revalidate_seconds
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.files = {}
+        self.requests = 0
+        self.fetched_bytes = 0
+        self.changed = 0
+        self.uncached = 0
+
+        self.blocks = LRUCache(max_bytes, weigher=lambda size: size, on_evict=lambda name, size: self.remove(name))
+
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def load(self):
+        """Picks up the blocks left by a previous run, oldest first."""
+        found = []
+        for entry in os.scandir(self.directory):
+            if block_re.search(entry.name):
+                st = entry.stat()
+                found.append((st.st_mtime_ns, entry.name, st.st_size))
+            elif entry.name.endswith('.tmp'):
+                os.remove(entry.path)
+
+        for _, name, size in sorted(found):
+            self.blocks.put(name, size)
+
+    def remove(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def request(self, url, method='GET', headers=None):
+        """Returns the status, headers and body of a response."""
+        with self.lock:
+            self.requests += 1
+
+        request = urllib.request.Request(url, method=method, headers=headers or {})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, response.headers, response.read()
+        except OSError as e:
+            # Including timeouts, and HTTP errors.
+            raise OSError('datasette-parquet: failed to fetch {}: {}'.format(url, e)) from e
+
+    def stat(self, url):
+        """Returns a RemoteFile for url, asking the server if we haven't
+        recently."""
+        now = time.monotonic()
+        with self.lock:
+            cached = self.files.get(url)
+        if cached and now - cached[1] < self.revalidate_seconds:
+            return cached[0]
+
+        _, headers, _ = self.request(url, method='HEAD')
+        size = headers.get('Content-Length')
+        if size is None:
+            # Ask for the first byte instead; the response says how big the
+            # whole file is.
+            _, headers, _ = self.request(url, headers={'Range': 'bytes=0-0'})
+            m = content_range_re.search(headers.get('Content-Range') or '')
+            if not m:
+                raise OSError('datasette-parquet: {} did not say how big it is'.format(url))
+            size = m.group(1)
+        rv = RemoteFile(url, int(size), validator_for(headers))
+
+        with self.lock:
+            if cached and cached[0].validator != rv.validator:
+                self.changed += 1
+            self.files[url] = (rv, now)
+        return rv
+
+    def forget(self, url):
+        with self.lock:
+            self.files.pop(url, None)
+
+    def block_name(self, remote, index):
+        key = '\0'.join([remote.url, remote.validator, str(self.block_size)])
+        return '{}.{}'.format(hashlib.sha1(key.encode('utf-8')).hexdigest(), index)
+
+    def fetch_range(self, remote, start, end):
+        """Fetches bytes [start, end) of remote from the server."""
+        status, headers, data = self.request(remote.url, headers={'Range': 'bytes={}-{}'.format(start, end - 1)})
+        if remote.validator is not None and validator_for(headers) != remote.validator:
+            # What we've read of it so far may be from the old version.
+            self.forget(remote.url)
+            with self.lock:
+                self.changed += 1
+            raise OSError('{} changed while it was being read'.format(remote.url))
+
+        # The server ignored the Range header and sent the whole file.
+        if status == 200:
+            data = data[start:end]
+
+        with self.lock:
+            self.fetched_bytes += len(data)
+        return data
+
+    def read_block(self, remote, index):
+        name = self.block_name(remote, index)
+        if self.blocks.get(name) is None:
+            return None
+
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Keep the recency for the next run, too.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def write_block(self, remote, index, data):
+        name = self.block_name(remote, index)
+        tmp = os.path.join(self.directory, '{}.{}.tmp'.format(name, threading.get_ident()))
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(self.directory, name))
+        self.blocks.put(name, len(data))
+
+    def fetch_blocks(self, remote, first, last):
+        """Fetches blocks first to last, inclusive, in one request."""
+        start = first * self.block_size
+        data = self.fetch_range(remote, start, min((last + 1) * self.block_size, remote.size))
+
+        rv = {}
+        for index in range(first, last + 1):
+            offset = (index - first) * self.block_size
+            rv[index] = data[offset:offset + self.block_size]
+            self.write_block(remote, index, rv[index])
+        return rv
+
+    def read(self, url, start, end):
+        """Returns bytes [start, end) of the file at url."""
+        remote = self.stat(url)
+        end = min(end, remote.size)
+        if start >= end:
+            return b''
+
+        if remote.validator is None:
+            with self.lock:
+                self.uncached += 1
+            return self.fetch_range(remote, start, end)
+
+        first = start // self.block_size
+        last = (end - 1) // self.block_size
+
+        blocks = {}
+        missing = []
+        for index in range(first, last + 1):
+            data = self.read_block(remote, index)
+            if data is None:
+                missing.append(index)
+            else:
+                blocks[index] = data
+
+        # Fetch each run of consecutive missing blocks in one request.
+        runs = []
+        for index in missing:
+            if runs and runs[-1][1] == index - 1:
+                runs[-1][1] = index
+            else:
+                runs.append([index, index])
+        for run_first, run_last in runs:
+            blocks.update(self.fetch_blocks(remote, run_first, run_last))
+
+        data = b''.join(blocks[index] for index in range(first, last + 1))
+        offset = first * self.block_size
+        return data[start - offset:end - offset]
+
+    def stats(self):
+        rv = self.blocks.stats()
+        with self.lock:
+            rv.update({
+                'requests': self.requests,
+                'fetched_bytes': self.fetched_bytes,
+                'changed': self.changed,
+                'uncached': self.uncached,
+            })
+        return rv
+
+if AbstractFileSystem is not None:
+    class CachedFile(AbstractBufferedFile):
+        def _fetch_range(self, start, end):
+            return self.fs.cache.read(self.path, start, end)
+
+    class CachedHTTPFileSystem(AbstractFileSystem):
+        """Lets DuckDB read http:// and https:// URLs through a RangeCache."""
+
+        protocol = ('http', 'https')
+        cachable = False
+
+        def __init__(self, cache, **kwargs):
+            super().__init__(**kwargs)
+            self.cache = cache
+
+        @classmethod
+        def _strip_protocol(cls, path):
+            return path
+
+        def info(self, path, **kwargs):
+            return {'name': path, 'size': self.cache.stat(path).size, 'type': 'file'}
+
+        def _open(self, path, mode='rb', block_size=None, autocommit=True, cache_options=None, **kwargs):
+            if mode != 'rb':
+                raise NotImplementedError('remote files are read-only')
+
+            # The RangeCache does the caching, so don't buffer reads here too.
+            return CachedFile(self, path, mode, block_size=self.cache.block_size, cache_type='none', autocommit=autocommit, **kwargs)
+else:
+    CachedHTTPFileSystem = None
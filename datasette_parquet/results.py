@@ -0,0 +1,219 @@
+import re
+import sys
+import sqlglot
+from sqlglot import exp
+from .lru import LRUCache
+from .shared import SQLITE_MASTER_VIEW
+
+# Queries whose results can change even when the files don't.
+volatile_re = re.compile(r'\b(random|now|current_date|current_time|current_timestamp|gen_random_uuid|uuid|nextval|setseed)\b', re.IGNORECASE)
+
+def referenced_tables(sql):
+    """Returns the set of tables sql reads from, or None if we can't be sure."""
+    if volatile_re.search(sql):
+        return None
+
+    try:
+        expression = sqlglot.parse_one(sql, read='duckdb')
+    except sqlglot.errors.ParseError:
+        return None
+
+    if not isinstance(expression, (exp.Select, exp.Union)):
+        return None
+
+    ctes = {cte.alias for cte in expression.find_all(exp.CTE)}
+
+    rv = set()
+    for table in expression.find_all(exp.Table):
+        # An empty name is a table function, like read_parquet(...), which
+        # could read anything.
+        if not table.name:
+            return None
+
+        if not table.name in ctes:
+            rv.add(table.name)
+
+    if not rv:
+        return None
+
+    return frozenset(rv)
+
+def weigh(value):
+    """A rough estimate of how many bytes a cached result holds on to."""
+    description, rows = value
+    rv = sys.getsizeof(rows)
+    for row in rows:
+        rv += sys.getsizeof(row)
+        for x in row:
+            rv += sys.getsizeof(x)
+    return rv
+
+class ResultCache:
+    """Cache the rows of read-only queries.
+
+    Entries are keyed by the rewritten SQL, its parameters, and the
+    fingerprints of the files behind each table the query reads, so a changed
+    file never serves a stale result. fingerprint is called with a set of
+    table names, and returns a hashable fingerprint, or None if any of the
+    tables can't be fingerprinted."""
+
+    def __init__(self, max_bytes, fingerprint):
+        self.max_bytes = max_bytes
+        self.fingerprint = fingerprint
+        self.entries = LRUCache(max_bytes, weigher=weigh)
+        self.tables = LRUCache(1024)
+
+    def key(self, sql, parameters):
+        """Returns the cache key for a query, or None if it isn't cacheable."""
+        tables = self.tables.get_or_compute(sql, referenced_tables)
+        if tables is None:
+            return None
+
+        fingerprint = self.fingerprint(tables)
+        if fingerprint is None:
+            return None
+
+        rv = (sql, tuple(parameters or ()), fingerprint)
+        try:
+            hash(rv)
+        except TypeError:
+            return None
+        return rv
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, description, rows):
+        self.entries.put(key, (description, rows))
+
+    def lookup(self, key):
+        """Returns a CachedResult for key, or None."""
+        cached = self.get(key)
+        if cached is None:
+            return None
+        return CachedResult(*cached)
+
+    def recorder(self, cursor, key):
+        """Wraps cursor so that its rows are cached under key once fetched."""
+        return RecordingResult(
+            cursor,
+            lambda description, rows: self.put(key, description, rows),
+            self.max_bytes
+        )
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return self.entries.stats()
+
+DEFAULT_SCHEMA_CACHE_BYTES = 4 * 1024 * 1024
+
+# Datasette's introspection queries, once they've been through rewrite().
+introspection_re = re.compile(r'^(PRAGMA |SELECT \*, 0 FROM pragma_table_info\(|SELECT 0 WHERE 1 = 0$)', re.IGNORECASE)
+
+class SchemaCache(ResultCache):
+    """Cache the answers to Datasette's schema introspection queries.
+
+    Datasette looks up the same tables, columns, foreign keys and indexes on
+    every page. The answers only change when the views do, so rather than
+    fingerprinting files, entries are keyed by a generation number that's
+    bumped whenever the views are reloaded."""
+
+    def __init__(self, max_bytes=DEFAULT_SCHEMA_CACHE_BYTES):
+        super().__init__(max_bytes, None)
+        self.generation = 0
+
+    def is_introspection(self, sql):
+        if introspection_re.search(sql):
+            return True
+        return self.tables.get_or_compute(sql, referenced_tables) in ({'sqlite_master'}, {SQLITE_MASTER_VIEW})
+
+    def key(self, sql, parameters):
+        if not self.is_introspection(sql):
+            return None
+
+        rv = (self.generation, sql, tuple(parameters or ()))
+        try:
+            hash(rv)
+        except TypeError:
+            return None
+        return rv
+
+    def invalidate(self):
+        self.generation += 1
+        self.clear()
+
+class CachedResult:
+    """Serves a cached result set through the DB-API fetch methods."""
+
+    def __init__(self, description, rows):
+        self.description = description
+        self.rows = rows
+        self.pos = 0
+
+    def fetchone(self):
+        if self.pos >= len(self.rows):
+            return None
+        self.pos += 1
+        return self.rows[self.pos - 1]
+
+    def fetchmany(self, size=1):
+        rv = self.rows[self.pos:self.pos + size]
+        self.pos += len(rv)
+        return rv
+
+    def fetchall(self):
+        rv = self.rows[self.pos:]
+        self.pos = len(self.rows)
+        return rv
+
+class RecordingResult:
+    """Wraps a DuckDB cursor, remembering the rows fetched from it.
+
+    Once the result set is exhausted, on_complete is called with the
+    description and rows. If the rows outgrow max_bytes, we stop recording,
+    so streaming a huge result doesn't hold it all in memory."""
+
+    def __init__(self, cursor, on_complete, max_bytes):
+        self.cursor = cursor
+        self.description = cursor.description
+        self.on_complete = on_complete
+        self.max_bytes = max_bytes
+        self.rows = []
+        self.bytes = 0
+
+    def record(self, tpls, exhausted):
+        if self.rows is None:
+            return
+
+        for tpl in tpls:
+            self.bytes += sys.getsizeof(tpl) + sum(sys.getsizeof(x) for x in tpl)
+
+        if self.bytes > self.max_bytes:
+            self.rows = None
+            return
+
+        self.rows.extend(tpls)
+
+        if exhausted:
+            self.on_complete(self.description, self.rows)
+            self.rows = None
+
+    def fetchone(self):
+        tpl = self.cursor.fetchone()
+        if tpl is None:
+            self.record([], True)
+        else:
+            self.record([tpl], False)
+        return tpl
+
+    def fetchmany(self, size=1):
+        tpls = self.cursor.fetchmany(size)
+        self.record(tpls, len(tpls) < size)
+        return tpls
+
+    def fetchall(self):
+        tpls = self.cursor.fetchall()
+        self.record(tpls, True)
+        return tpls
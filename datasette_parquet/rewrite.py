@@ -1,18 +1,55 @@
 import re
 import sqlglot
 import sqlite3
+from sqlglot import exp
 table_xinfo_re = re.compile('^PRAGMA table_xinfo[(](.+)[)]')
 table_info_square_re = re.compile('^PRAGMA table_info[(]\[(.+)][)]')
 
 NO_OP_SQL = 'SELECT 0 WHERE 1 = 0'
 
+# The clause Datasette adds for ?_search= and ?_search_column=
+fts_clause_re = re.compile(
+    r'\browid in \(select rowid from (\[[^\]]+\]|\w+) where (\[[^\]]+\]|\w+) match (?:escape_fts\(:(\w+)\)|:(\w+))\)'
+)
+
+def unbracket(name):
+    if name.startswith('['):
+        return name[1:-1]
+    return name
+
+def translate_fts_clause(m):
+    """DuckDB has no MATCH, so mark the search for SearchIndexes to answer."""
+    fts_table = unbracket(m.group(1))
+    column = unbracket(m.group(2))
+    if column == fts_table:
+        column = ''
+
+    return "datasette_fts_match('{}', '{}', :{}, {})".format(
+        fts_table.replace("'", "''"),
+        column.replace("'", "''"),
+        m.group(3) or m.group(4),
+        0 if m.group(3) else 1
+    )
+
+def translate_dates(node):
+    """SQLite's date(x) is x's date as a string, or NULL if x isn't a date.
+
+    Datasette's date facets group by it, so make it a cast that DuckDB can
+    run natively over the column. TRY_CAST gives NULL, rather than an error,
+    for values that aren't dates, like SQLite does."""
+    if not isinstance(node, exp.Anonymous) or node.name.upper() != 'DATE' or len(node.expressions) != 1:
+        return node
+
+    arg = node.expressions[0]
+    if isinstance(arg, exp.Literal) and arg.is_string and arg.this.lower() == 'now':
+        return exp.CurrentDate()
+
+    return exp.TryCast(this=arg, to=exp.DataType.build('date'))
+
 
 def rewrite(sql):
     # print('rewrite: {}'.format(sql))
 
-    if ' DATE(' in sql or ' date(' in sql:
-        sql = NO_OP_SQL
-
     sql = sql.replace('<> ""', "<> ''")
     sql = sql.replace('!= ""', "!= ''")
 
@@ -27,11 +64,6 @@ def rewrite(sql):
 
     sql = sql.replace('"????-??-*"', "'????-??-*'")
 
-    # TODO: once sqlglot #1066 lands, we can remove this
-    if ' GLOB ' in sql or ' glob ' in sql:
-        print('WARNING: rewriting a GLOB to a LIKE, this is almost certainly wrong')
-        sql = sql.replace(' GLOB ', ' LIKE ').replace(' glob ', ' LIKE ')
-
     if sql == 'PRAGMA schema_version':
         sql = 'SELECT 0'
 
@@ -74,11 +106,14 @@ def rewrite(sql):
     if 'VIRTUAL TABLE%USING FTS' in sql:
         sql = NO_OP_SQL
 
+    sql = fts_clause_re.sub(translate_fts_clause, sql)
+
     # Transpile queries, eg [test] is not a valid way to quote a table
     # in DuckDB.
     #print('before transpile: {}'.format(sql))
     if not sql.startswith('PRAGMA') and not sql.startswith('COPY ') and not "from '" in sql:
-        sql = sqlglot.transpile(sql, read='sqlite', write='duckdb')[0]
+        expression = sqlglot.parse(sql, read='sqlite')[0]
+        sql = expression.transform(translate_dates).sql(dialect='duckdb')
 
     #print('after transpile: {}'.format(sql))
 
@@ -0,0 +1,88 @@
+import re
+import threading
+import duckdb
+from .winging_it import translate
+
+# Each mount's own view of the catalog, which its queries read instead of
+# sqlite_master.
+SQLITE_MASTER_VIEW = 'datasette_sqlite_master'
+
+# References to sqlite_master, skipping over string literals and quoted
+# identifiers.
+sqlite_master_re = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|\bsqlite_master\b""")
+
+def quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+def string(value):
+    return "'{}'".format(value.replace("'", "''"))
+
+def translate_shared(sql):
+    """As translate, but for a database that lives in a SharedInstance."""
+    sql, names = translate(sql)
+
+    def replace(m):
+        if m.group(0) == 'sqlite_master':
+            return SQLITE_MASTER_VIEW
+        return m.group(0)
+
+    return sqlite_master_re.sub(replace, sql), names
+
+def sqlite_master_sql(schema, catalog, catalog_schema):
+    """A view in memory.schema that lists what catalog.catalog_schema has, in
+    the shape of sqlite_master."""
+    where = 'database_name = {} and schema_name = {}'.format(string(catalog), string(catalog_schema))
+    return '''CREATE VIEW memory.{schema}.{view} AS
+SELECT 'table' AS type, table_name AS name, table_name AS tbl_name, 0 AS rootpage, sql FROM duckdb_tables() WHERE {where}
+UNION ALL
+SELECT 'view', view_name, view_name, 0, sql FROM duckdb_views() WHERE {where} AND NOT internal AND view_name <> {view_name}
+UNION ALL
+SELECT 'index', index_name, table_name, 0, sql FROM duckdb_indexes() WHERE {where}'''.format(
+        schema=quote(schema),
+        view=SQLITE_MASTER_VIEW,
+        view_name=string(SQLITE_MASTER_VIEW),
+        where=where
+    )
+
+class SharedInstance:
+    """One DuckDB instance for several mounted databases.
+
+    Each DuckDB instance has its own buffer manager, thread pool and
+    metadata cache, so databases with their own instances compete for the
+    same memory and cores. Instead, databases can share one instance, with
+    one budget between them.
+
+    Each database is mounted as a schema of the instance's in-memory
+    catalog: a directory's views live there, and a DuckDB file is attached
+    as a catalog of its own. Every connection a database makes sets its
+    search_path to its mount, so queries see only its own tables.
+
+    DuckDB's sqlite_master lists the tables of every catalog, and can't be
+    shadowed, so each mount has a view of its own tables, and queries are
+    rewritten to read that instead; see translate_shared."""
+
+    def __init__(self, config=None):
+        self.config = config or {}
+        self.conn = duckdb.connect(config=self.config)
+        self.lock = threading.Lock()
+
+        # The first database with http_cache sets up the instance's.
+        self.range_cache = None
+
+    def mount_directory(self, name):
+        """Creates a schema for a directory's views. Returns its search_path."""
+        with self.lock:
+            self.conn.execute('CREATE SCHEMA memory.{}'.format(quote(name)))
+            self.conn.execute(sqlite_master_sql(name, 'memory', name))
+        return 'memory.{}'.format(quote(name))
+
+    def mount_file(self, name, file):
+        """Attaches a DuckDB file, read-only. Returns its search_path."""
+        with self.lock:
+            self.conn.execute('ATTACH {} AS {} (READ_ONLY)'.format(string(file), quote(name)))
+            self.conn.execute('CREATE SCHEMA memory.{}'.format(quote(name)))
+            self.conn.execute(sqlite_master_sql(name, name, 'main'))
+        return '{}.main,memory.{}'.format(quote(name), quote(name))
+
+    def connect(self):
+        return self.conn.cursor()
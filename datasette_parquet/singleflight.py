@@ -0,0 +1,46 @@
+import asyncio
+
+class SingleFlight:
+    """Shares one run of a piece of work between everyone who asks for it
+    while it's in flight.
+
+    When a popular page is requested by many people at once, each request
+    runs the same queries. Instead, the first request for a key starts the
+    work, and later ones wait for its result, or its exception. Once the
+    work finishes, the key is forgotten: this isn't a cache.
+
+    The work runs in its own task, so a caller that goes away doesn't cancel
+    it for the others."""
+
+    def __init__(self):
+        self.calls = {}
+        self.started = 0
+        self.shared = 0
+
+    async def run(self, key, fn):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self.calls[key] = task
+            self.started += 1
+            task.add_done_callback(lambda t: self.done(key, t))
+        else:
+            self.shared += 1
+
+        return await asyncio.shield(task)
+
+    def done(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+
+        # If every caller went away, nobody saw the exception; don't let
+        # asyncio complain about it.
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        return {
+            'in_flight': len(self.calls),
+            'started': self.started,
+            'shared': self.shared,
+        }
@@ -0,0 +1,153 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import deque
+
+# Used to group queries that differ only in their literals.
+string_literal_re = re.compile(r"'(?:[^']|'')*'")
+number_literal_re = re.compile(r'\b\d+(?:\.\d+)?\b')
+whitespace_re = re.compile(r'\s+')
+
+def normalize(sql):
+    sql = string_literal_re.sub('?', sql)
+    sql = number_literal_re.sub('?', sql)
+    return whitespace_re.sub(' ', sql).strip()
+
+def percentile(values, p):
+    """The nearest-rank percentile of a sorted list."""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+class QueryRecord:
+    """Where the time went for a single query."""
+
+    __slots__ = (
+        'sql', 'started', 'rewrite_ms', 'execute_ms', 'fetch_ms', 'rows',
+        'rewrite_cache_hit', 'result_cache_hit', 'ran', 'profile'
+    )
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.started = time.time()
+        self.rewrite_ms = 0
+        self.execute_ms = 0
+        self.fetch_ms = 0
+        self.rows = 0
+        self.rewrite_cache_hit = False
+        self.result_cache_hit = False
+        # Whether DuckDB ran it, rather than a cache answering it.
+        self.ran = False
+        self.profile = None
+
+    @property
+    def total_ms(self):
+        return self.rewrite_ms + self.execute_ms + self.fetch_ms
+
+class QueryStats:
+    """Keeps timings for the most recent queries run against a database.
+
+    Recording a query is cheap: it's appended to a bounded window, and the
+    cursor fills in its timings as it goes. Grouping and percentiles are
+    only computed when someone asks for a summary.
+
+    If profile_threshold_ms is set, every connection writes DuckDB's JSON
+    profiling output to a scratch file, and queries that take longer than the
+    threshold keep a copy of it."""
+
+    def __init__(self, window=10000, profile_threshold_ms=None):
+        self.records = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.profile_threshold_ms = profile_threshold_ms
+
+    def start(self, sql):
+        record = QueryRecord(sql)
+        with self.lock:
+            self.records.append(record)
+        return record
+
+    def enable_profiling(self, conn):
+        """Turns on profiling for a raw DuckDB connection, if it's wanted.
+
+        Returns the path the profiles will be written to, or None."""
+        if self.profile_threshold_ms is None:
+            return None
+
+        fd, path = tempfile.mkstemp(prefix='datasette-parquet-profile-', suffix='.json')
+        os.close(fd)
+        conn.execute("SET enable_profiling='json'")
+        conn.execute("SET profiling_output='{}'".format(path))
+        return path
+
+    def will_run(self, record, profile_path):
+        """Called just before DuckDB runs a query."""
+        record.ran = True
+
+        # Empty the scratch file, so that a query DuckDB doesn't write a
+        # profile for can't pick up the previous query's.
+        if profile_path is not None:
+            open(profile_path, 'w').close()
+
+    def finish(self, record, profile_path):
+        """Called once a query's results have all been fetched."""
+        if profile_path is None or not record.ran or record.total_ms < self.profile_threshold_ms:
+            return
+
+        try:
+            with open(profile_path) as f:
+                record.profile = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def disable_profiling(self, profile_path):
+        """Called when a connection closes, to remove its scratch file."""
+        if profile_path is None:
+            return
+
+        try:
+            os.remove(profile_path)
+        except FileNotFoundError:
+            pass
+
+    def summary(self, top=10):
+        with self.lock:
+            records = list(self.records)
+
+        groups = {}
+        for record in records:
+            groups.setdefault(normalize(record.sql), []).append(record)
+
+        queries = []
+        for sql, group in groups.items():
+            totals = sorted(r.total_ms for r in group)
+            profiled = [r for r in group if r.profile is not None]
+            queries.append({
+                'sql': sql,
+                'count': len(group),
+                'rows': sum(r.rows for r in group),
+                'rewrite_ms': sum(r.rewrite_ms for r in group) / len(group),
+                'execute_ms': sum(r.execute_ms for r in group) / len(group),
+                'fetch_ms': sum(r.fetch_ms for r in group) / len(group),
+                'p50_ms': percentile(totals, 50),
+                'p90_ms': percentile(totals, 90),
+                'p99_ms': percentile(totals, 99),
+                'max_ms': totals[-1],
+                'rewrite_cache_hits': sum(1 for r in group if r.rewrite_cache_hit),
+                'result_cache_hits': sum(1 for r in group if r.result_cache_hit),
+                'profile': max(profiled, key=lambda r: r.total_ms).profile if profiled else None,
+            })
+
+        queries.sort(key=lambda q: q['max_ms'], reverse=True)
+
+        totals = sorted(r.total_ms for r in records)
+        return {
+            'queries': len(records),
+            'p50_ms': percentile(totals, 50),
+            'p90_ms': percentile(totals, 90),
+            'p99_ms': percentile(totals, 99),
+            'slowest': queries[:top],
+        }
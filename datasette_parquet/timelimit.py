@@ -0,0 +1,68 @@
+import threading
+
+class Watchdog:
+    """Enforce Datasette's query time limits on DuckDB connections.
+
+    Datasette enforces time limits by installing a SQLite progress handler
+    that returns a truthy value once the deadline has passed. DuckDB has no
+    progress handlers, so instead a background thread polls the handlers of
+    the connections that are running queries and interrupts any whose
+    handler says it's time to stop."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.watched = {}
+        self.thread = None
+
+    def watch(self, conn, handler):
+        with self.cond:
+            self.watched[id(conn)] = (conn, handler)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='datasette-parquet-watchdog', daemon=True)
+                self.thread.start()
+
+            self.cond.notify()
+
+    def unwatch(self, conn):
+        with self.cond:
+            self.watched.pop(id(conn), None)
+
+    def shutdown(self):
+        """Stops the thread; the next watch() starts another."""
+        with self.cond:
+            thread = self.thread
+            self.thread = None
+            self.cond.notify_all()
+
+        if thread is not None:
+            thread.join()
+
+    def run(self):
+        me = threading.current_thread()
+        while True:
+            with self.cond:
+                # Once shut down, another thread may have taken over.
+                while not self.watched and self.thread is me:
+                    self.cond.wait()
+                if self.thread is not me:
+                    return
+                watched = list(self.watched.values())
+
+            for entry in watched:
+                conn, handler = entry
+                if not handler():
+                    continue
+
+                # Interrupt while holding the lock, so that the query can't
+                # finish and be replaced by a new one before the interrupt lands.
+                with self.cond:
+                    if self.watched.get(id(conn)) is entry:
+                        del self.watched[id(conn)]
+                        conn.interrupt()
+
+            with self.cond:
+                self.cond.wait(self.interval)
+
+watchdog = Watchdog()
@@ -1,12 +1,21 @@
 import time
 import re
+import sqlite3
 import typing
+from contextlib import contextmanager
 
-from duckdb import BinderException 
+from duckdb import BinderException, InterruptException
 
 from .rewrite import rewrite, NO_OP_SQL
+from .lru import LRUCache
+from .prepared import PreparedStatements, DEFAULT_STATEMENT_CACHE_SIZE
+from .timelimit import watchdog
 from . import exceptions
 
+# Datasette sends the same introspection, count and facet SQL on every page
+# render, so remember what we rewrote it to rather than re-running sqlglot.
+DEFAULT_REWRITE_CACHE_SIZE = 1024
+
 
 # a regular expression to find the literal wrapped by the double quoted string
 # GOOD for DuckDB, works fine:  
@@ -29,161 +38,369 @@ def find_matching_double_quote_usage(ex: BinderException) -> typing.List[str]:
     matches = re.findall(pattern, referenced_column_message)
     return matches
 
+@contextmanager
+def translate_errors():
+    """
+    Re-raise DuckDB exceptions as the exceptions Datasette knows how to handle.
+    """
+    try:
+        yield
+    except BinderException as ex:
+        matches = find_matching_double_quote_usage(ex)
+        if matches:
+            raise exceptions.DoubleQuoteForLiteraValue(matches)
+        else:
+            # continue raising the original BinderException
+            raise
+    except InterruptException as ex:
+        # Datasette turns this into a QueryInterrupted, same as for SQLite.
+        raise sqlite3.OperationalError('interrupted') from ex
+
 
 # A collection of classes to provide a facade that mimics the sqlite3 DB-API
 # interface.
 class Row:
+    """A row of a result set, indexable by position or by column name.
+
+    The column name -> index map is built once per result set and shared by
+    every row in it, so a row costs little more than its tuple."""
+
+    __slots__ = ('columns', 'tpl')
+
     def __init__(self, columns, tpl):
         self.columns = columns
         self.tpl = tpl
 
     def __getitem__(self, key):
-        if isinstance(key, int):
+        if isinstance(key, (int, slice)):
             return self.tpl[key]
         else:
             return self.tpl[self.columns[key]]
 
-def fixup_params(sql, parameters):
-    if isinstance(parameters, dict):
-        # On the custom SQL page, Datasette jams any query parameter it finds
-        # into the parameters for the backend. DuckDB is strict on unexpected
-        # parameters, so try to remove them
+    def keys(self):
+        return list(self.columns.names)
+
+    def __iter__(self):
+        return iter(self.tpl)
+
+    def __len__(self):
+        return len(self.tpl)
+
+    def __eq__(self, other):
+        if not isinstance(other, Row):
+            return NotImplemented
+        return self.columns == other.columns and self.tpl == other.tpl
+
+    def __hash__(self):
+        return hash((tuple(self.columns), self.tpl))
 
-        new_parameters = {}
-        for k, v in parameters.items():
-            if ':{}'.format(k) in sql:
-                new_parameters[k] = v
+    def __repr__(self):
+        return 'Row({!r})'.format(self.tpl)
 
-        parameters = new_parameters
+class ColumnIndex(dict):
+    """Column name -> position, for a result set.
 
-    # Sometimes we skip queries that DuckDB can't handle, eg DATE(...) facet queries.
-    # If the old query had parameters, sending them with the new query will
-    # cause an assertion to fail. So return an empty list of parameters.
+    Like sqlite3, a name that's used twice finds the first column with it,
+    but names keeps every column's name, in order."""
+
+    __slots__ = ('names',)
+
+    def __init__(self, names):
+        super().__init__()
+        self.names = tuple(names)
+        for i, name in enumerate(self.names):
+            self.setdefault(name, i)
+
+def column_index(description):
+    return ColumnIndex(x[0] for x in description)
+
+# Named parameters, skipping over anything in a string literal, quoted
+# identifier or comment, and DuckDB's :: casts.
+param_re = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|--[^\n]*|/\*.*?\*/|::|:([A-Za-z_][A-Za-z0-9_]*)""", re.S)
+
+def bind_names(sql):
+    """Rewrites sql's :name parameters to DuckDB's positional $1, $2, ...
+
+    Returns the new SQL, and the parameter names in positional order. A name
+    that's used more than once gets the same position each time."""
+    names = []
+
+    def replace(m):
+        name = m.group(1)
+        if name is None:
+            return m.group(0)
+
+        if not name in names:
+            names.append(name)
+        return '${}'.format(names.index(name) + 1)
+
+    return param_re.sub(replace, sql), tuple(names)
+
+def translate(sql):
+    """Translates a SQLite query to DuckDB, returning the new SQL and the
+    names of its parameters, in order."""
+    sql = rewrite(sql)
+
+    # Sometimes we skip queries that DuckDB can't handle. If the old query
+    # had parameters, the new one doesn't.
     if sql == NO_OP_SQL:
-        return sql, []
+        return sql, ()
 
+    return bind_names(sql)
+
+def bind(names, parameters):
+    """Returns the list of values for a query with the given parameter names."""
     if isinstance(parameters, (tuple, list)):
-        return sql, parameters
-    else:
-        new_params = []
-        for i, (k, v) in enumerate((parameters or {}).items()):
-            new_params.append(v)
-            sql = sql.replace(':' + k, '${}'.format(i + 1))
+        return parameters
+
+    # On the custom SQL page, Datasette jams any query parameter it finds
+    # into the parameters for the backend. DuckDB is strict on unexpected
+    # parameters, so only pass on the ones the query uses.
+    parameters = parameters or {}
+    try:
+        return [parameters[name] for name in names]
+    except KeyError as e:
+        raise sqlite3.ProgrammingError('You did not supply a value for binding parameter :{}.'.format(e.args[0]))
 
-        #print('new sql: {}'.format(sql))
-        #print('new params: {}'.format(new_params))
-        return sql, new_params
+def fixup_params(sql, parameters):
+    sql, names = bind_names(sql)
+    return sql, bind(names, parameters)
 
 class ProxyCursor:
-    def __init__(self, conn, existing_cursor=None):
-        self.conn = conn
+    def __init__(self, proxy, existing_cursor=None):
+        self.proxy = proxy
+        self.conn = proxy.conn
+        self._columns = None
 
         if existing_cursor:
             self.cursor = existing_cursor
         else:
             self.cursor = self.conn.cursor()
 
+        # Where rows are fetched from: the DuckDB cursor, or a cached result.
+        self.result = self.cursor
+
+        # Timings for the current query, if the connection keeps stats.
+        self.record = None
+
     def execute(self, sql, parameters=None):
+        self.finish()
+        self._columns = None
+
+        stats = self.proxy.stats
+        record = stats.start(sql) if stats else None
+        self.record = record
+
         #print('# params={} sql={}'.format(parameters, sql))
-        sql = rewrite(sql)
-        sql, parameters = fixup_params(sql, parameters)
+        t = time.perf_counter()
+        sql, parameters = self.proxy.prepare(sql, parameters, record)
+
+        # Introspection is answered from the schema cache; anything else
+        # might be in the result cache.
+        result_cache = self.proxy.schema_cache
+        key = result_cache.key(sql, parameters) if result_cache else None
+        if key is None:
+            result_cache = self.proxy.result_cache
+            key = result_cache.key(sql, parameters) if result_cache else None
+        if key:
+            cached = result_cache.lookup(key)
+            if cached:
+                self.result = cached
+                if record:
+                    record.result_cache_hit = True
+                    record.rewrite_ms = (time.perf_counter() - t) * 1000
+                return self
 
         #print('## params={} sql={}'.format(parameters, sql))
-        t = time.time()
-        try:
-            rv = self.cursor.execute(sql, parameters)
-        except BinderException as ex:
-            matches = find_matching_double_quote_usage(ex)
-            if matches:
-                raise exceptions.DoubleQuoteForLiteraValue(matches)
+        if record:
+            stats.will_run(record, self.proxy.profile_path)
+
+        t2 = time.perf_counter()
+        with translate_errors():
+            if self.cursor is self.conn:
+                self.proxy.statements.execute(sql, parameters)
             else:
-                # continue raising the original BinderException
-                raise
+                self.cursor.execute(sql, parameters)
+
+        if key:
+            self.result = result_cache.recorder(self.cursor, key)
+        else:
+            self.result = self.cursor
+
+        if record:
+            record.rewrite_ms = (t2 - t) * 1000
+            record.execute_ms = (time.perf_counter() - t2) * 1000
+        return self
+
+    def fetched(self, t, rows, exhausted):
+        record = self.record
+        record.fetch_ms += (time.perf_counter() - t) * 1000
+        record.rows += rows
+        if exhausted:
+            self.finish()
+
+    def finish(self):
+        if self.record:
+            self.proxy.stats.finish(self.record, self.proxy.profile_path)
+            self.record = None
+
+    @property
+    def description(self):
+        return self.result.description
 
-        #print('took {}'.format(time.time() - t))
-        return rv
+    @property
+    def columns(self):
+        if self._columns is None:
+            self._columns = column_index(self.result.description)
+        return self._columns
 
     def fetchone(self):
-        tpl = self.cursor.fetchone()
+        t = time.perf_counter()
+        with translate_errors():
+            tpl = self.result.fetchone()
+
+        if self.record:
+            self.fetched(t, 1 if tpl else 0, not tpl)
 
         if not tpl:
             return tpl
 
-        columns = {}
-        for i, x in enumerate(self.cursor.description):
-            columns[x[0]] = i
-
-        return Row(columns, tpl)
+        return Row(self.columns, tpl)
 
     def fetchmany(self, size=1):
-        tpls = self.cursor.fetchmany(size)
-        columns = {}
-        for i, x in enumerate(self.cursor.description):
-            columns[x[0]] = i
+        t = time.perf_counter()
+        with translate_errors():
+            tpls = self.result.fetchmany(size)
 
+        if self.record:
+            self.fetched(t, len(tpls), len(tpls) < size)
+
+        columns = self.columns
         return [Row(columns, tpl) for tpl in tpls]
 
     def fetchall(self):
-        tpls = self.cursor.fetchall()
-        columns = {}
-        for i, x in enumerate(self.cursor.description):
-            columns[x[0]] = i
+        t = time.perf_counter()
+        with translate_errors():
+            tpls = self.result.fetchall()
+
+        if self.record:
+            self.fetched(t, len(tpls), True)
 
+        columns = self.columns
         return [Row(columns, tpl) for tpl in tpls]
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        rv = self.cursor.fetchone()
+        t = time.perf_counter()
+        with translate_errors():
+            rv = self.result.fetchone()
+
+        if self.record:
+            self.fetched(t, 0 if rv is None else 1, rv is None)
 
         if rv == None:
             raise StopIteration
 
-        columns = {}
-        for i, x in enumerate(self.cursor.description):
-            columns[x[0]] = i
-        rv = Row(columns, rv)
-        return rv
+        return Row(self.columns, rv)
 
     def __getattr__(self, name):
         return getattr(self.cursor, name)
 
 class ProxyConnection:
-    def __init__(self, conn):
+    def __init__(self, conn, rewrite_cache=None, parquet_counts=None, result_cache=None, schema_cache=None, stats=None, statement_cache_size=DEFAULT_STATEMENT_CACHE_SIZE, translate=translate, search_path=None, search_indexes=None):
         self.conn = conn
 
+        # In a shared instance, each connection only sees its own mount.
+        self.search_path = search_path
+        if search_path:
+            conn.execute("SET search_path = '{}'".format(search_path.replace("'", "''")))
+        self.translate = translate
+
+        if rewrite_cache is None:
+            rewrite_cache = LRUCache(DEFAULT_REWRITE_CACHE_SIZE)
+        self.rewrite_cache = rewrite_cache
+        self.parquet_counts = parquet_counts
+        self.search_indexes = search_indexes
+        self.result_cache = result_cache
+        self.schema_cache = schema_cache
+        self.stats = stats
+        self.profile_path = stats.enable_profiling(conn) if stats else None
+
+        # Prepared statements belong to a DuckDB connection, so unlike our
+        # other caches, this one isn't shared with duplicates.
+        self.statement_cache_size = statement_cache_size
+        self.statements = PreparedStatements(conn, statement_cache_size)
+
+    def close(self):
+        self.conn.close()
+        if self.stats:
+            self.stats.disable_profiling(self.profile_path)
+
     def __enter__(self):
         pass
 
     def __exit__(self, exc_type,exc_value, exc_traceback):
         pass
 
+    def duplicate(self):
+        """Returns a new connection to the same database, sharing our caches."""
+        return ProxyConnection(
+            self.conn.cursor(),
+            rewrite_cache=self.rewrite_cache,
+            parquet_counts=self.parquet_counts,
+            result_cache=self.result_cache,
+            schema_cache=self.schema_cache,
+            stats=self.stats,
+            statement_cache_size=self.statement_cache_size,
+            translate=self.translate,
+            search_path=self.search_path,
+            search_indexes=self.search_indexes
+        )
+
+    def prepare(self, sql, parameters, record=None):
+        """Translates a SQLite query and its parameters into their DuckDB equivalents."""
+        translated = self.rewrite_cache.get(sql)
+        if translated is None:
+            translated = self.translate(sql)
+            self.rewrite_cache.put(sql, translated)
+        elif record:
+            record.rewrite_cache_hit = True
+        sql, names = translated
+
+        # Unfiltered counts and pages of Parquet views can use the footers.
+        if self.parquet_counts:
+            footer_sql = self.parquet_counts.rewrite(self.conn, sql)
+            if footer_sql:
+                return footer_sql, []
+
+        parameters = bind(names, parameters)
+
+        # ?_search= is answered from the full-text indexes.
+        if self.search_indexes:
+            searched = self.search_indexes.rewrite(self.conn, sql, parameters)
+            if searched:
+                sql = searched
+
+        return sql, parameters
+
     def execute(self, sql, parameters=None):
-        #print('! params={} sql={}'.format(parameters, sql))
-        sql = rewrite(sql)
-        #print('! rewritten sql={}'.format(sql))
-        sql, parameters = fixup_params(sql, parameters)
-        #print('!! params={} sql={}'.format(parameters, sql))
-        try:
-            rv = self.conn.execute(sql, parameters)
-        except BinderException as ex:
-            matches = find_matching_double_quote_usage(ex)
-            if matches:
-                raise exceptions.DoubleQuoteForLiteraValue(matches)
-            else:
-                # continue raising the original BinderException
-                raise
-            
-        return ProxyCursor(self.conn, rv)
+        cursor = self.cursor()
+        cursor.execute(sql, parameters)
+        return cursor
 
     def fetchall(self):
         raise Exception('TODO: ProxyConnection.fetchall is not implemented')
 
     def set_progress_handler(self, handler, n):
-        pass
+        # Datasette uses this to enforce its time limits; see timelimit.py
+        if handler is None:
+            watchdog.unwatch(self.conn)
+        else:
+            watchdog.watch(self.conn, handler)
 
     def cursor(self):
-        return ProxyCursor(self.conn)
-
-
+        # Share the connection rather than opening a new one per cursor, so
+        # that the watchdog interrupts the connection that's doing the work.
+        return ProxyCursor(self, self.conn)
@@ -32,7 +32,7 @@ setup(
     version=VERSION,
     packages=["datasette_parquet"],
     entry_points={"datasette": ["parquet = datasette_parquet"]},
-    install_requires=["datasette", "duckdb", "sqlglot", "watchdog"],
-    extras_require={"test": ["pytest", "pytest-asyncio", "pytest-watch"]},
+    install_requires=["datasette", "duckdb>=0.9.0", "sqlglot", "watchdog"],
+    extras_require={"test": ["pytest", "pytest-asyncio", "pytest-watch", "fsspec", "pyarrow"], "http_cache": ["fsspec"], "csv": ["pyarrow"]},
     python_requires=">=3.7",
 )
@@ -1,9 +1,32 @@
+import asyncio
+import csv
+import http.server
+import io
+import os
+import shutil
+import sqlite3
+import threading
+import time
 from datasette.app import Datasette
+from datasette.database import QueryInterrupted
 from .create_db import create_dbs
 import pytest
 import duckdb
-from datasette_parquet.winging_it import ProxyConnection
+from datasette_parquet.winging_it import ProxyConnection, bind_names
+from datasette_parquet.rewrite import rewrite
 from datasette_parquet import exceptions
+from datasette_parquet.lru import LRUCache
+from datasette_parquet.pool import ConnectionPool, PoolClosed
+from datasette_parquet.counts import ParquetCounts
+from datasette_parquet.ducky import DuckDatabase, sync_views
+from datasette_parquet.results import ResultCache
+from datasette_parquet.catalog import SchemaCatalog
+from datasette_parquet.ddl import view_definitions, parquet_globs
+from datasette_parquet.convert import ParquetConverter
+from datasette_parquet.stats import QueryStats
+from datasette_parquet.export import jsonable_rows, unlimited
+from datasette_parquet.rangecache import RangeCache
+from datasette_parquet.executor import PriorityExecutor, priority_for, PRIORITY_USER, PRIORITY_INTROSPECTION
 
 @pytest.fixture(scope="session")
 def datasette():
@@ -67,6 +90,160 @@ async def test_duckdb_table(datasette):
     response = await datasette.client.get("/duckdb/fixtures")
     assert response.status_code == 200
 
+@pytest.mark.asyncio
+async def test_date_facets(datasette):
+    response = await datasette.client.get("/trove/fixtures.json?_facet_date=ts")
+    assert response.status_code == 200
+    results = response.json()['facet_results']['ts']['results']
+    assert [(r['value'], r['count']) for r in results] == [('2023-01-02', 1)]
+    assert [f['name'] for f in response.json()['suggested_facets'] if f['type'] == 'date'] == ['date']
+
+    response = await datasette.client.get("/trove/fixtures.json?ts__date=2023-01-02&_shape=array")
+    assert len(response.json()) == 1
+    response = await datasette.client.get("/trove/fixtures.json?ts__date=2023-01-03&_shape=array")
+    assert response.json() == []
+
+@pytest.mark.asyncio
+async def test_streamed_csv():
+    ds = Datasette([], memory=True, metadata={'plugins': {'datasette-parquet': {'trove': {'directory': './trove'}}}})
+    await ds.invoke_startup()
+
+    response = await ds.client.get('/trove/userdata1.csv?_stream=on')
+    assert response.status_code == 200
+    streamed = list(csv.reader(io.StringIO(response.text)))
+    assert len(streamed) == 1001
+
+    # The same values as Datasette's own CSV for the first page.
+    response = await ds.client.get('/trove/userdata1.csv?_size=5')
+    assert list(csv.reader(io.StringIO(response.text))) == streamed[:6]
+
+    response = await ds.client.get('/trove/userdata1.csv?_stream=on&gender=Male&_header=off')
+    assert len(list(csv.reader(io.StringIO(response.text)))) == 451
+
+    response = await ds.client.get('/trove/userdata1.csv?_stream=on&gender=Nobody')
+    assert list(csv.reader(io.StringIO(response.text))) == [streamed[0]]
+
+    # Exports give their connections back to the pool.
+    pool = ds.get_database('trove').pool
+    assert pool.live <= pool.size and len(pool.idle) == pool.live
+
+@pytest.mark.asyncio
+async def test_streamed_csv_with_other_queries(tmp_path):
+    duckdb.connect().execute("COPY (SELECT i, 'row ' || i AS s FROM range(2000000) t(i)) TO '{}/big.parquet' (FORMAT PARQUET)".format(tmp_path))
+    ds = Datasette([], memory=True, metadata={'plugins': {'datasette-parquet': {'big': {
+        'directory': str(tmp_path),
+        'pool_size': 1,
+    }}}})
+    await ds.invoke_startup()
+
+    pool = ds.get_database('big').pool
+
+    async def query_while_exporting():
+        # Wait until the export has held the connection for a while.
+        held = 0
+        while held < 100:
+            await asyncio.sleep(0.001)
+            held = held + 1 if pool.live == 1 and not pool.idle else 0
+        return await ds.client.get('/big.json?sql=select+count(*)+as+n+from+big&_shape=array')
+
+    # With one connection, an export and a query that arrives while it's
+    # running both finish.
+    export, count = await asyncio.wait_for(asyncio.gather(
+        ds.client.get('/big/big.csv?_stream=on&_header=off'),
+        query_while_exporting(),
+    ), 30)
+    assert export.text.count('\n') == 2000000
+    assert count.json() == [{"n": 2000000}]
+    assert len(pool.idle) == pool.live == 1
+
+@pytest.mark.asyncio
+async def test_streamed_csv_time_limit(tmp_path):
+    duckdb.connect().execute("COPY (SELECT i, 'row ' || i AS s FROM range(5000000) t(i)) TO '{}/big.parquet' (FORMAT PARQUET)".format(tmp_path))
+    ds = Datasette([], memory=True, metadata={'plugins': {'datasette-parquet': {'big': {
+        'directory': str(tmp_path),
+        'export_time_limit_ms': 50,
+    }}}})
+    await ds.invoke_startup()
+
+    response = await ds.client.get('/big/big.csv?_stream=on&_sort=s')
+    assert 'Interrupted' in response.text
+    assert response.text.count('\n') < 5000000
+
+def test_jsonable_rows():
+    import datetime
+    import decimal
+    rows = [
+        (1, datetime.date(2023, 1, 1), None, [datetime.time(1, 2)]),
+        (2, None, decimal.Decimal('1.5'), None),
+    ]
+    assert jsonable_rows(rows) == [
+        [1, '2023-01-01', None, ['01:02:00']],
+        [2, None, 1.5, None],
+    ]
+    assert jsonable_rows([]) == []
+    assert unlimited('select * from t where x = :x order by y limit 101 offset 5') == 'SELECT * FROM t WHERE x = :x ORDER BY y'
+
+@pytest.mark.asyncio
+async def test_facets_share_one_scan():
+    ds = Datasette([], memory=True, metadata={'plugins': {'datasette-parquet': {'trove': {'directory': './trove'}}}})
+    await ds.invoke_startup()
+
+    response = await ds.client.get('/trove/userdata1.json?_facet=gender&_facet=country&gender=Male&_facet_size=3')
+    assert response.status_code == 200
+    facets = response.json()['facet_results']
+    assert [(r['value'], r['count']) for r in facets['gender']['results']] == [('Male', 451)]
+    assert [(r['value'], r['count']) for r in facets['country']['results']] == [('China', 88), ('Indonesia', 45), ('Russia', 24)]
+    assert facets['country']['truncated']
+
+    # Neither facet ran a GROUP BY of its own.
+    queries = ds.get_database('trove').stats.summary(100)['slowest']
+    assert [q for q in queries if 'grouping sets' in q['sql']]
+    assert not [q for q in queries if 'count(*) as count from (' in q['sql'] and not 'grouping sets' in q['sql']]
+    assert [q for q in queries if q['sql'].endswith('order by _grouping, _rank')]
+
+@pytest.mark.asyncio
+async def test_sampled_facet_suggestions():
+    ds = Datasette([], memory=True, metadata={'plugins': {'datasette-parquet': {'trove': {'directory': './trove', 'suggest_sample_rows': 500}}}})
+    await ds.invoke_startup()
+    db = ds.get_database('trove')
+
+    for _ in range(2):
+        response = await ds.client.get('/trove/userdata1.json')
+        assert [f['name'] for f in response.json()['suggested_facets'] if not 'type' in f] == ['gender']
+    assert db.suggestion_cache.stats()['hits'] == 1
+
+    # Filtered to one gender, it's no longer worth faceting by.
+    response = await ds.client.get('/trove/userdata1.json?gender=Male')
+    assert [f['name'] for f in response.json()['suggested_facets'] if not 'type' in f] == []
+
+@pytest.mark.asyncio
+async def test_schema_cache(tmp_path):
+    shutil.copy('./trove/userdata1.parquet', tmp_path)
+    ds = Datasette([], memory=True, metadata={'plugins': {'datasette-parquet': {'trove': {'directory': str(tmp_path)}}}})
+    await ds.invoke_startup()
+    db = ds.get_database('trove')
+
+    await ds.client.get('/trove/userdata1')
+    before = db.schema_cache.stats()
+    await ds.client.get('/trove/userdata1')
+    after = db.schema_cache.stats()
+    assert after['hits'] > before['hits']
+    assert after['misses'] == before['misses']
+
+    # New views are seen once the directory's been reloaded.
+    shutil.copy('./trove/userdata2.parquet', tmp_path)
+    assert await db.view_names() == ['userdata1']
+    db.reload()
+    assert sorted(await db.view_names()) == ['userdata1', 'userdata2']
+
+def test_rewrite_dates():
+    assert rewrite('select date([ts]) from t') == 'SELECT TRY_CAST("ts" AS DATE) FROM t'
+    assert rewrite("select date('now')") == 'SELECT CURRENT_DATE'
+
+def test_rewrite_search():
+    assert rewrite('select * from t where rowid in (select rowid from [t_fts] where [t_fts] match escape_fts(:search))') == "SELECT * FROM t WHERE DATASETTE_FTS_MATCH('t_fts', '', :search, 0)"
+    assert rewrite('select * from t where rowid in (select rowid from t_fts where [title] match :search_0)') == "SELECT * FROM t WHERE DATASETTE_FTS_MATCH('t_fts', 'title', :search_0, 1)"
+
 def test_fetchone():
     raw_conn = duckdb.connect()
     conn = ProxyConnection(raw_conn)
@@ -84,4 +261,656 @@ def test_catch_double_quote_usage_for_literal(datasette):
     explodey_string_with_double_quotes = 'SELECT * from "./trove/userdata1.parquet" WHERE first_name = "Amanda"'
 
     with pytest.raises(exceptions.DoubleQuoteForLiteraValue):
-        result = conn.execute(explodey_string_with_double_quotes).fetchall()
\ No newline at end of file
+        result = conn.execute(explodey_string_with_double_quotes).fetchall()
+
+
+def test_rewrite_cache():
+    raw_conn = duckdb.connect()
+    conn = ProxyConnection(raw_conn, rewrite_cache=LRUCache(2))
+
+    for _ in range(3):
+        assert conn.execute('SELECT 1 AS col').fetchone()['col'] == 1
+
+    assert conn.rewrite_cache.stats() == {'hits': 2, 'misses': 1, 'size': 1, 'maxsize': 2}
+
+    conn.execute('SELECT 2')
+    conn.execute('SELECT 3')
+    assert len(conn.rewrite_cache) == 2
+    assert conn.rewrite_cache.get('SELECT 1 AS col') is None
+
+def test_named_parameters():
+    sql = "SELECT :p1 AS a, :p10 AS b, ':p1' AS c, 2::INT AS d, :p1 AS e"
+    assert bind_names(sql) == ("SELECT $1 AS a, $2 AS b, ':p1' AS c, 2::INT AS d, $1 AS e", ('p1', 'p10'))
+
+    conn = ProxyConnection(duckdb.connect())
+    row = conn.execute('select :p1 as a, :p10 as b, :p1 as c', {'p10': 'ten', 'p1': 'one', 'csrftoken': 'x'}).fetchone()
+    assert tuple(row) == ('one', 'ten', 'one')
+
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute('select :p1 as a', {})
+
+def test_prepared_statements():
+    conn = ProxyConnection(duckdb.connect(), statement_cache_size=2)
+    conn.conn.execute("CREATE VIEW people AS SELECT * FROM (VALUES (1, 'ann'), (2, 'o''brien')) t(id, name)")
+
+    sql = 'select name from people where id = :id'
+    assert conn.execute(sql, {'id': 2}).fetchall()[0]['name'] == "o'brien"
+    assert conn.execute(sql, {'id': 1}).fetchall()[0]['name'] == 'ann'
+    assert conn.statements.names.stats()['hits'] == 1
+
+    # Values that can't be written as literals run the query unprepared.
+    assert conn.execute('select :x as x', {'x': b'bytes'}).fetchone()['x'] == b'bytes'
+    assert conn.execute('select :x as x', {'x': 0.1}).fetchone()['x'] == 0.1
+
+    # Evicted statements are deallocated.
+    conn.execute('select 1')
+    with pytest.raises(duckdb.Error):
+        conn.conn.execute('EXECUTE datasette_parquet_0(1)')
+
+def test_connection_pool():
+    root = ProxyConnection(duckdb.connect())
+    root.conn.execute('CREATE VIEW answer AS SELECT 42 AS x')
+    pool = ConnectionPool(root, 2)
+
+    a = pool.acquire()
+    b = pool.acquire()
+    assert a.conn is not b.conn
+    assert a.execute('SELECT x FROM answer').fetchone()['x'] == 42
+    assert b.execute('SELECT x FROM answer').fetchone()['x'] == 42
+
+    # Connections that are checked out survive the pool being closed...
+    pool.release(a)
+    pool.close()
+    assert b.execute('SELECT x FROM answer').fetchone()['x'] == 42
+
+    with pytest.raises(PoolClosed):
+        pool.acquire()
+    with pytest.raises(sqlite3.ProgrammingError, match='closed database'):
+        pool.run(lambda conn: None)
+
+    # ...and the root goes away with the last of them.
+    pool.release(b)
+    with pytest.raises(duckdb.ConnectionException):
+        root.conn.execute('SELECT 1')
+
+@pytest.mark.asyncio
+async def test_concurrent_queries_share_one_run():
+    ds = Datasette([], memory=True, metadata={'plugins': {'datasette-parquet': {'trove': {'directory': './trove'}}}})
+    await ds.invoke_startup()
+    db = ds.get_database('trove')
+
+    sql = 'select gender, count(*) from userdata1 where country = :country group by gender order by gender'
+    results = await asyncio.gather(*[
+        db.execute(sql, {'country': 'China', 'csrftoken': str(i)})
+        for i in range(5)
+    ])
+    assert len({tuple(tuple(row) for row in r.rows) for r in results}) == 1
+    assert db.in_flight.stats() == {'in_flight': 0, 'started': 1, 'shared': 4}
+    assert len([q for q in db.stats.summary(100)['slowest'] if 'userdata1' in q['sql']]) == 1
+
+    # Different parameters are different queries.
+    await asyncio.gather(db.execute(sql, {'country': 'China'}), db.execute(sql, {'country': 'Canada'}))
+    assert db.in_flight.stats()['started'] == 3
+
+    # Everyone sees the error...
+    errors = await asyncio.gather(*[db.execute('select nope from userdata1') for _ in range(3)], return_exceptions=True)
+    assert isinstance(errors[0], exceptions.DoubleQuoteForLiteraValue)
+    assert all(e is errors[0] for e in errors)
+
+    # ...and the timeout.
+    slow = 'select count(*) from generate_series(1, 1000000000000)'
+    errors = await asyncio.gather(*[db.execute(slow, custom_time_limit=50) for _ in range(3)], return_exceptions=True)
+    assert all(isinstance(e, QueryInterrupted) for e in errors)
+
+    # A caller that goes away doesn't cancel the run for the others.
+    first = asyncio.ensure_future(db.execute(sql, {'country': 'Russia'}))
+    second = asyncio.ensure_future(db.execute(sql, {'country': 'Russia'}))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert (await second).rows
+    assert db.in_flight.stats()['in_flight'] == 0
+
+@pytest.mark.asyncio
+async def test_sql_time_limit(datasette):
+    ds = Datasette(
+        [],
+        memory=True,
+        settings={'sql_time_limit_ms': 250},
+        metadata={
+            'plugins': {
+                'datasette-parquet': {
+                    'trove': {
+                        'directory': './fixtures'
+                    }
+                }
+            }
+        }
+    )
+
+    response = await ds.client.get('/trove.json?sql=select+count(*)+from+generate_series(1,+1000000000000)&_shape=array')
+    assert response.status_code == 400
+    assert 'SQL query took too long' in response.text
+
+    # The connection is still usable afterwards.
+    response = await ds.client.get('/trove.json?sql=select+1+as+x&_shape=array')
+    assert response.json() == [{'x': 1}]
+
+def test_row():
+    conn = ProxyConnection(duckdb.connect())
+    rows = conn.execute('SELECT * FROM (VALUES (1, 2), (3, 4)) t(a, b)').fetchall()
+    assert rows[0].keys() == ['a', 'b']
+    assert tuple(rows[1]) == (3, 4)
+    assert rows[1]['b'] == 4
+    assert rows[1][0] == 3
+    assert rows[1][-1] == 4
+    assert len(rows[0]) == 2
+
+    # Repeated names are kept, and find the first column, as in sqlite3.
+    [row] = conn.execute('SELECT 1 AS a, 2 AS a').fetchall()
+    assert row.keys() == ['a', 'a']
+    assert row['a'] == 1
+    # The column index is shared by every row in the result set.
+    assert rows[0].columns is rows[1].columns
+
+    cursor = conn.cursor()
+    cursor.execute('SELECT 1 AS x')
+    assert [dict(zip(row.keys(), row)) for row in cursor] == [{'x': 1}]
+    cursor.execute('SELECT 2 AS y')
+    assert cursor.fetchone()['y'] == 2
+
+def test_parquet_counts():
+    raw_conn = duckdb.connect()
+    raw_conn.execute("CREATE VIEW userdata AS SELECT * FROM './trove/*.parquet'")
+    counts = ParquetCounts({'userdata': './trove/*.parquet'})
+    conn = ProxyConnection(raw_conn, parquet_counts=counts)
+
+    assert conn.prepare('select count(*) from [userdata] ', {}) == ('SELECT 2000 AS "count_star()"', [])
+    assert conn.execute('select count(*) from [userdata] ').fetchone()[0] == 2000
+
+    # Filtered counts still go to DuckDB.
+    sql, _ = conn.prepare('select count(*) from [userdata] where id < 10', {})
+    assert sql == 'SELECT COUNT(*) FROM "userdata" WHERE id < 10'
+    assert conn.execute(sql).fetchone()[0] == 17
+
+def test_parquet_pages(tmp_path):
+    raw_conn = duckdb.connect()
+    for i in range(3):
+        raw_conn.execute("COPY (SELECT {} AS part, i FROM range(10) t(i)) TO '{}/{}.parquet' (FORMAT PARQUET)".format(i, tmp_path, i))
+    raw_conn.execute("CREATE VIEW parts AS SELECT * FROM '{}/*.parquet'".format(tmp_path))
+    counts = ParquetCounts({'parts': '{}/*.parquet'.format(tmp_path)})
+    conn = ProxyConnection(raw_conn, parquet_counts=counts)
+
+    # Deep pages read their rows by position, rather than skipping over the
+    # rows before them.
+    sql, params = conn.prepare('select * from parts limit 5 offset 8', {})
+    assert 'file_row_number' in sql and not 'OFFSET' in sql and params == []
+
+    for sql in ['select * from parts limit 5 offset 8', 'select i from [parts] limit 30 offset 1', 'select * from parts limit 5 offset 40']:
+        expected = raw_conn.execute(sql.replace('[parts]', 'parts')).fetchall()
+        assert [tuple(row) for row in conn.execute(sql).fetchall()] == expected
+
+    # Filtered pages still use OFFSET.
+    sql, _ = conn.prepare('select * from parts where i > 3 limit 5 offset 8', {})
+    assert sql.endswith('OFFSET 8')
+
+    # As do queries whose select list works on more than the page's rows.
+    for sql in [
+        'select distinct part from parts limit 5 offset 0',
+        'select row_number() over () as n from parts limit 2 offset 5',
+        'select count(*) over () from parts limit 2 offset 0',
+        'select count(*) from parts limit 1 offset 0',
+        'select i + :n from parts limit 2 offset 3',
+    ]:
+        prepared, _ = conn.prepare(sql, {'n': 1})
+        assert not 'file_row_number' in prepared
+        expected = raw_conn.execute(sql.replace(':n', '1')).fetchall()
+        assert [tuple(row) for row in conn.execute(sql, {'n': 1}).fetchall()] == expected
+
+@pytest.mark.asyncio
+async def test_deep_pages():
+    ds = Datasette([], memory=True, metadata={'plugins': {'datasette-parquet': {'trove': {'directory': './trove'}}}})
+    await ds.invoke_startup()
+
+    response = await ds.client.get('/trove/userdata1.json?_size=50&_next=900')
+    assert [row[1] for row in response.json()['rows']] == list(range(901, 951))
+    assert response.json()['next'] == '950'
+
+    sql, _ = ds.get_database('trove').pool.root.prepare('select id from userdata1 limit 51 offset 900', {})
+    assert 'file_row_number' in sql
+
+def test_sync_views(tmp_path):
+    shutil.copy('./trove/userdata1.parquet', tmp_path)
+    conn = duckdb.connect()
+
+    views = sync_views(conn, str(tmp_path), {})
+    assert list(views) == ['userdata1']
+
+    # A query that's already streaming results keeps its view definition.
+    running = conn.cursor()
+    running.execute('SELECT id FROM userdata1')
+    assert running.fetchone() == (1,)
+
+    shutil.copy('./trove/userdata2.parquet', tmp_path)
+    new_views = sync_views(conn, str(tmp_path), views)
+    assert list(new_views) == ['userdata1', 'userdata2']
+    assert sync_views(conn, str(tmp_path), new_views) is new_views
+
+    os.remove(tmp_path / 'userdata1.parquet')
+    views = sync_views(conn, str(tmp_path), new_views)
+    assert list(views) == ['userdata2']
+    assert conn.execute("SELECT view_name FROM duckdb_views() WHERE NOT internal").fetchall() == [('userdata2',)]
+    assert len(running.fetchall()) == 999
+
+def test_result_cache():
+    fingerprints = {'answer': 1}
+    cache = ResultCache(1000000, lambda tables: tuple(fingerprints.get(t) for t in sorted(tables)))
+    raw_conn = duckdb.connect()
+    raw_conn.execute('CREATE VIEW answer AS SELECT 42 AS x')
+    conn = ProxyConnection(raw_conn, result_cache=cache)
+
+    assert conn.execute('SELECT x FROM answer').fetchall()[0]['x'] == 42
+    assert cache.stats()['hits'] == 0
+
+    # Served from the cache, so it doesn't notice the view changed...
+    raw_conn.execute('CREATE OR REPLACE VIEW answer AS SELECT 43 AS x')
+    cursor = conn.execute('SELECT x FROM answer')
+    assert cursor.description[0][0] == 'x'
+    assert cursor.fetchone()['x'] == 42
+    assert cache.stats()['hits'] == 1
+
+    # ...until its files do.
+    fingerprints['answer'] = 2
+    assert conn.execute('SELECT x FROM answer').fetchall()[0]['x'] == 43
+
+    # Queries that don't read a view, or are volatile, aren't cached.
+    assert cache.key('SELECT 1', []) is None
+    assert cache.key('SELECT random() FROM answer', []) is None
+    assert cache.key("SELECT * FROM read_parquet('x.parquet')", []) is None
+
+def test_schema_catalog(tmp_path):
+    data = tmp_path / 'data'
+    data.mkdir()
+    (data / 'people.csv').write_text('id,name\n1,Alice\n2,Bob\n')
+    shutil.copy('./trove/userdata1.parquet', str(data / 'users.parquet'))
+    catalog_path = str(tmp_path / 'catalog.json')
+
+    conn = duckdb.connect()
+    catalog = SchemaCatalog(catalog_path)
+    views = sync_views(conn, str(data), {}, catalog)
+    assert "columns={'id': 'BIGINT', 'name': 'VARCHAR'}" in views['people']
+    assert list(catalog.entries) == ['people']
+    assert conn.execute('SELECT name FROM people WHERE id = 2').fetchall() == [('Bob',)]
+
+    # A new catalog reuses the saved schema without sniffing.
+    catalog = SchemaCatalog(catalog_path)
+    catalog.sniff = None
+    assert view_definitions(str(data), catalog) == views
+
+    # ...until the file changes.
+    (data / 'people.csv').write_text('id,name,age\n1,Alice,30\n')
+    catalog = SchemaCatalog(catalog_path)
+    assert "'age': 'BIGINT'" in view_definitions(str(data), catalog)['people']
+
+def test_parquet_converter(tmp_path):
+    data = tmp_path / 'data'
+    data.mkdir()
+    (data / 'people.csv').write_text('id,name\n1,Alice\n2,Bob\n')
+    cache_dir = str(tmp_path / 'cache')
+
+    conn = duckdb.connect()
+    state = {'views': {}}
+    def reload():
+        state['views'] = sync_views(conn, str(data), state['views'], converter=converter)
+        converter.remove_retired()
+    converter = ParquetConverter(cache_dir, on_converted=reload, grace_seconds=0)
+
+    # The view reads the CSV until the conversion is done...
+    reload()
+    assert 'read_csv_auto' in state['views']['people']
+    converter.wait()
+
+    # ...and then the Parquet copy.
+    assert cache_dir in state['views']['people']
+    assert conn.execute('SELECT name FROM people WHERE id = 2').fetchall() == [('Bob',)]
+    [old_copy] = os.listdir(cache_dir)
+
+    # Changing the file converts it again. The old copy is kept until a later
+    # reload, for queries that were already reading it.
+    (data / 'people.csv').write_text('id,name\n1,Alice\n2,Bob\n3,Carol\n')
+    reload()
+    converter.wait()
+    assert conn.execute('SELECT count(*) FROM people').fetchall() == [(3,)]
+    assert len(os.listdir(cache_dir)) == 2 and old_copy in os.listdir(cache_dir)
+
+    reload()
+    assert len(os.listdir(cache_dir)) == 1 and not old_copy in os.listdir(cache_dir)
+
+@pytest.mark.asyncio
+async def test_search_indexes(tmp_path):
+    shutil.copy('./trove/userdata1.parquet', tmp_path / 'userdata1.parquet')
+    (tmp_path / 'parts').mkdir()
+    shutil.copy('./trove/userdata1.parquet', tmp_path / 'parts' / 'a.parquet')
+    shutil.copy('./trove/userdata2.parquet', tmp_path / 'parts' / 'b.parquet')
+
+    ds = Datasette([], memory=True, metadata={'plugins': {'datasette-parquet': {'s': {
+        'directory': str(tmp_path),
+        'fts': {'userdata1': ['first_name', 'last_name', 'title'], 'parts': ['title', 'country']},
+    }}}})
+    await ds.invoke_startup()
+    db = ds.get_database('s')
+    db.search_indexes.wait()
+
+    # Each file has an index next to it.
+    assert len([f for f in os.listdir(tmp_path / 'parts') if f.endswith('.fts')]) == 2
+    assert await db.fts_table('userdata1') == 'userdata1_fts'
+
+    response = await ds.client.get('/s/userdata1.json?_search=accountant+IV&_shape=objects')
+    assert [row['id'] for row in response.json()['rows']] == [2, 558, 981]
+    assert response.json()['filtered_table_rows_count'] == 3
+
+    response = await ds.client.get('/s/userdata1.json?_search_title=account*&_searchmode=raw')
+    assert response.json()['filtered_table_rows_count'] == 80
+    response = await ds.client.get('/s/userdata1.json?_search_first_name=accountant')
+    assert response.json()['filtered_table_rows_count'] == 0
+    response = await ds.client.get('/s/userdata1.json?_search_email=x')
+    assert response.status_code == 400
+
+    # Across several files, with other filters and facets.
+    response = await ds.client.get('/s/parts.json?_search=accountant&country=China&_facet=gender&_shape=objects')
+    assert response.json()['filtered_table_rows_count'] == 17
+    assert sum(r['count'] for r in response.json()['facet_results']['gender']['results']) == 17
+
+    # Changing a file indexes it again, and removes the old index.
+    old = sorted(os.listdir(tmp_path / 'parts'))
+    shutil.copy('./trove/userdata1.parquet', tmp_path / 'parts' / 'b.parquet')
+    db.reload()
+    db.search_indexes.wait()
+    new = sorted(os.listdir(tmp_path / 'parts'))
+    assert len(new) == 4 and old[1] == new[1] and old[3] != new[3]
+    response = await ds.client.get('/s/parts.json?_search=accountant+iv')
+    assert response.json()['filtered_table_rows_count'] == 6
+
+    # A failed build is reported, and tried again on the next reload.
+    columns = db.search_indexes.indexes['parts']
+    db.search_indexes.indexes['parts'] = ['title', 'no_such_column']
+    db.reload()
+    db.search_indexes.wait()
+    response = await ds.client.get('/s/parts.json?_search=accountant')
+    assert response.status_code == 400
+    assert 'could not be built' in response.json()['error']
+    assert len(db.summary()['caches']['search']['failed']) == 2
+
+    db.search_indexes.indexes['parts'] = columns
+    db.reload()
+    db.search_indexes.wait()
+    response = await ds.client.get('/s/parts.json?_search=accountant+iv')
+    assert response.json()['filtered_table_rows_count'] == 6
+    assert db.summary()['caches']['search']['failed'] == []
+
+def test_schema_events_ignore_sidecars():
+    from watchdog.events import FileCreatedEvent, FileMovedEvent
+    from datasette_parquet.ducky import SchemaEventHandler
+
+    handler = SchemaEventHandler(lambda: None)
+    assert handler.wanted(FileCreatedEvent('/data/a.parquet'))
+    assert not handler.wanted(FileCreatedEvent('/data/a.parquet.0123456789abcdef.fts.tmp'))
+    assert not handler.wanted(FileMovedEvent('/data/a.parquet.0123456789abcdef.fts.tmp', '/data/a.parquet.0123456789abcdef.fts'))
+    assert handler.wanted(FileMovedEvent('/data/a.parquet', '/data/b.parquet'))
+
+def test_hive_partitioned_views(tmp_path):
+    conn = duckdb.connect()
+    for year, month in [(2022, 12), (2023, 1)]:
+        partition = tmp_path / 'sales' / 'year={}'.format(year) / 'month={}'.format(month)
+        partition.mkdir(parents=True)
+        conn.execute("COPY (SELECT {} AS amount) TO '{}' (FORMAT PARQUET)".format(month, partition / 'part-0.parquet'))
+    (tmp_path / 'sales' / '_SUCCESS').write_text('')
+
+    views = sync_views(conn, str(tmp_path), {})
+    assert "read_parquet('{}/sales/**/*.parquet', hive_partitioning=true, union_by_name=true)".format(tmp_path) in views['sales']
+    assert conn.execute('SELECT amount, year, month FROM sales WHERE year = 2023').fetchall() == [(1, 2023, 1)]
+
+    counts = ParquetCounts(parquet_globs(str(tmp_path)))
+    assert counts.count(conn, 'sales') == 2
+
+def test_benchmarks_run(tmp_path):
+    from benchmarks.run import run
+
+    rv = run(rows=100, repeat=1, data_dir=str(tmp_path))
+    assert rv['meta']['rows'] == 100
+    assert 'rewrite.facet' in rv['results']
+    assert 'request.csv_export' in rv['results']
+    assert 'rewrite.filtered_page_csv' in rv['results'] and 'request.table_jsonl' in rv['results']
+    assert all(result['median_ms'] >= 0 for result in rv['results'].values())
+
+def test_query_stats():
+    stats = QueryStats(profile_threshold_ms=0)
+    conn = ProxyConnection(duckdb.connect(), stats=stats)
+
+    for i in range(3):
+        conn.execute('SELECT * FROM generate_series(1, :n)', {'n': 10 + i}).fetchall()
+    conn.execute("SELECT 'hello'").fetchone()
+
+    summary = stats.summary()
+    assert summary['queries'] == 4
+    [query] = [q for q in summary['slowest'] if q['sql'] == 'SELECT * FROM generate_series(?, :n)']
+    assert query['count'] == 3
+    assert query['rows'] == 10 + 11 + 12
+    assert query['rewrite_cache_hits'] == 2
+    assert query['profile']['name'] == 'Query'
+
+    # Literals are normalized away.
+    assert any(q['sql'] == 'SELECT ?' for q in summary['slowest'])
+
+    # Queries answered from a cache didn't run, so they have no profile.
+    conn = ProxyConnection(duckdb.connect(), stats=stats, result_cache=ResultCache(1000000, lambda tables: ()))
+    conn.execute('CREATE VIEW t AS SELECT 1 AS x')
+    conn.execute('SELECT x FROM t').fetchall()
+    conn.execute('SELECT x FROM t').fetchall()
+    [query] = [q for q in stats.summary()['slowest'] if q['sql'] == 'SELECT x FROM t']
+    assert query['result_cache_hits'] == 1
+    assert [r.profile is not None for r in stats.records if r.sql == 'SELECT x FROM t'] == [True, False]
+
+    # Closing a connection removes its scratch file.
+    path = conn.profile_path
+    assert os.path.exists(path)
+    conn.close()
+    assert not os.path.exists(path)
+
+@pytest.mark.asyncio
+async def test_duckdb_stats_endpoint(datasette):
+    await datasette.client.get('/trove/fixtures.json')
+    response = await datasette.client.get('/-/duckdb.json')
+    assert response.status_code == 200
+    stats = response.json()['trove']
+    assert stats['queries'] > 0
+    assert stats['caches']['rewrite']['misses'] > 0
+
+    response = await datasette.client.get('/-/duckdb.json?top=abc')
+    assert response.status_code == 400
+
+def test_priority_executor():
+    executor = PriorityExecutor(1, 2)
+    started = threading.Event()
+    release = threading.Event()
+    ran = []
+
+    def block():
+        started.set()
+        release.wait()
+
+    executor.submit(block)
+    started.wait()
+    user = executor.submit(lambda: ran.append('user'), PRIORITY_USER)
+    introspection = executor.submit(lambda: ran.append('introspection'), PRIORITY_INTROSPECTION)
+
+    # The worker's busy and the queue is full, so more work is turned away.
+    with pytest.raises(exceptions.QueryQueueFull):
+        executor.submit(lambda: None)
+
+    release.set()
+    user.result()
+    assert ran == ['introspection', 'user']
+    executor.shutdown()
+
+    assert priority_for('PRAGMA table_info("x")') == PRIORITY_INTROSPECTION
+    assert priority_for('select count(*) from [x]') == PRIORITY_USER
+
+@pytest.mark.asyncio
+async def test_shared_instance(datasette):
+    ds = Datasette([], memory=True, metadata={'plugins': {'datasette-parquet': {
+        'trove': {'directory': './trove', 'shared': True, 'threads': 2},
+        'duckdb': {'file': './fixtures/fixtures.duckdb', 'shared': True, 'memory_limit': '1GB'},
+    }}})
+    await ds.invoke_startup()
+    trove, duck = ds.get_database('trove'), ds.get_database('duckdb')
+    assert trove.instance is duck.instance
+    assert trove.pool.root.conn.execute("select current_setting('threads'), current_setting('memory_limit')").fetchall() == [(2, '1.0GB')]
+
+    # Each database only sees its own tables.
+    assert sorted(await trove.view_names()) == ['userdata1', 'userdata2']
+    assert await trove.table_names() == []
+    assert await duck.table_names() == ['fixtures']
+    assert await duck.view_names() == []
+
+    response = await ds.client.get('/trove/userdata1.json?_facet=gender&_shape=objects')
+    assert response.status_code == 200
+    assert response.json()['filtered_table_rows_count'] == 1000
+    response = await ds.client.get('/duckdb/fixtures.json?_shape=array')
+    assert response.json() == [{'rowid': 0, 'date': '2023-01-01', 'ts': '2023-01-02T03:04:05'}]
+
+    # String literals are left alone.
+    response = await ds.client.get("/duckdb.json?sql=select+'sqlite_master'+as+x&_shape=array")
+    assert response.json() == [{'x': 'sqlite_master'}]
+
+    with pytest.raises(Exception, match='different values for threads'):
+        await Datasette([], memory=True, metadata={'plugins': {'datasette-parquet': {
+            'a': {'directory': './trove', 'shared': True, 'threads': 2},
+            'b': {'directory': './trove', 'shared': True, 'threads': 3},
+        }}}).invoke_startup()
+
+def test_resource_limits(tmp_path):
+    shutil.copy('./trove/userdata1.parquet', tmp_path)
+    spill = tmp_path / 'spill'
+    ds = Datasette([], memory=True)
+    db = DuckDatabase(ds, directory=str(tmp_path), threads=2, memory_limit='512MB', temp_directory=str(spill), object_cache=True)
+
+    # Every pooled connection shares the settings of the root.
+    settings = "SELECT current_setting('threads'), current_setting('memory_limit'), current_setting('temp_directory'), current_setting('enable_object_cache')"
+    conns = [db.pool.acquire() for _ in range(db.pool.size)]
+    for conn in conns:
+        assert tuple(conn.execute(settings).fetchone()) == (2, '512.0MB', str(spill), True)
+    for conn in conns:
+        db.pool.release(conn)
+
+    db.close()
+
+class RangeHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves files with ETags and byte ranges, like an object store."""
+
+    def send_head(self):
+        if self.path.startswith('/stall/'):
+            time.sleep(2)
+        path = self.translate_path(self.path.replace('/stall/', '/'))
+        with open(path, 'rb') as f:
+            data = f.read()
+        st = os.stat(path)
+
+        start, end = 0, len(data)
+        ranged = self.headers.get('Range')
+        if ranged:
+            first, last = ranged.split('=')[1].split('-')
+            start, end = int(first), int(last) + 1
+        self.server.requests.append((self.command, ranged))
+
+        self.send_response(206 if ranged else 200)
+        if ranged:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, len(data)))
+        if self.command == 'GET' or not self.server.hide_length:
+            self.send_header('Content-Length', str(end - start))
+        self.send_header('ETag', '"{}-{}"'.format(st.st_mtime_ns, st.st_size))
+        self.end_headers()
+        return io.BytesIO(data[start:end])
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def http_server(tmp_path):
+    served = tmp_path / 'served'
+    served.mkdir()
+    shutil.copy('./trove/userdata1.parquet', served)
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), lambda *args: RangeHandler(*args, directory=str(served)))
+    server.requests = []
+    server.hide_length = False
+    server.url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    server.served = served
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+def test_range_cache(tmp_path, http_server):
+    url = http_server.url + 'userdata1.parquet'
+    expected = open('./trove/userdata1.parquet', 'rb').read()
+
+    cache = RangeCache(str(tmp_path / 'cache'), max_bytes=100000, block_size=16384, revalidate_seconds=0)
+    assert cache.read(url, 1000, 40000) == expected[1000:40000]
+    # One HEAD, and one GET for the three missing blocks.
+    assert http_server.requests == [('HEAD', None), ('GET', 'bytes=0-49151')]
+    assert cache.read(url, 20000, 30000) == expected[20000:30000]
+    assert [method for method, _ in http_server.requests] == ['HEAD', 'GET', 'HEAD']
+    assert cache.stats()['hits'] == 1
+
+    # The end of the file is a short block.
+    assert cache.read(url, len(expected) - 10, len(expected) + 10) == expected[-10:]
+
+    # The least recently used blocks make room for new ones.
+    assert cache.read(url, 50000, 100000) == expected[50000:100000]
+    assert cache.stats()['size'] <= 100000
+    assert len(os.listdir(tmp_path / 'cache')) == len(cache.blocks)
+
+    # The blocks outlive the cache.
+    del http_server.requests[:]
+    cache = RangeCache(str(tmp_path / 'cache'), max_bytes=100000, block_size=16384, revalidate_seconds=0)
+    assert cache.read(url, 50000, 60000) == expected[50000:60000]
+    assert http_server.requests == [('HEAD', None)]
+
+    # A changed file gets a new ETag, so its old blocks aren't used.
+    shutil.copy('./trove/userdata2.parquet', http_server.served / 'userdata1.parquet')
+    changed = open('./trove/userdata2.parquet', 'rb').read()
+    assert cache.read(url, 50000, 60000) == changed[50000:60000]
+    assert cache.stats()['changed'] == 1
+
+    # Without a Content-Length, a ranged GET tells us the size.
+    http_server.hide_length = True
+    del http_server.requests[:]
+    assert cache.stat(url).size == len(changed)
+    assert http_server.requests == [('HEAD', None), ('GET', 'bytes=0-0')]
+
+    # A server that stops responding fails the read, rather than hanging.
+    cache = RangeCache(str(tmp_path / 'cache'), timeout=0.1)
+    with pytest.raises(OSError, match='failed to fetch'):
+        cache.read(http_server.url + 'stall/userdata1.parquet', 0, 100)
+
+@pytest.mark.asyncio
+async def test_http_cache(tmp_path, http_server):
+    url = http_server.url + 'userdata1.parquet'
+    ds = Datasette([], memory=True, metadata={'plugins': {'datasette-parquet': {'remote': {
+        'directory': str(tmp_path / 'served'),
+        'http_cache': str(tmp_path / 'cache'),
+    }}}})
+    await ds.invoke_startup()
+
+    sql = "select gender, count(*) as n from read_parquet('{}') group by gender order by gender".format(url)
+    response = await ds.client.get('/remote.json', params={'sql': sql, '_shape': 'array'})
+    assert response.json()[0] == {'gender': '', 'n': 67}
+
+    # Again, without fetching anything.
+    fetched = len(http_server.requests)
+    response = await ds.client.get('/remote.json', params={'sql': sql + ' limit 1', '_shape': 'array'})
+    assert response.json() == [{'gender': '', 'n': 67}]
+    assert len(http_server.requests) == fetched
+
+    stats = ds.get_database('remote').summary()['caches']['http']
+    assert stats['hits'] > 0 and stats['requests'] == fetched